@@ -0,0 +1,106 @@
+"""
+Measure the cost of emitting an output state as the message history grows.
+
+Each emit adds a turn to the history, as an agent loop would, and is timed
+until the client received it, JSON encoding included.
+
+Usage: poetry run python benchmarks/serialization.py
+"""
+
+import asyncio
+import os
+import sys
+import time
+from typing import Any, List, Optional
+
+from pydantic import BaseModel
+
+# Import the looplit package of this checkout, even when it is not installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from looplit.serializer import ensure_values_serializable, json_backend
+from looplit.session import Session
+from looplit.state import State
+
+
+class Function(BaseModel):
+    name: str
+    arguments: str
+
+
+class ToolCall(BaseModel):
+    id: str
+    type: str = "function"
+    function: Function
+
+
+class Message(BaseModel):
+    """Stand-in for an OpenAI ChatCompletionMessage."""
+
+    role: str
+    content: Optional[str] = None
+    tool_calls: Optional[List[ToolCall]] = None
+
+
+def build_turn(i: int) -> List[Any]:
+    return [
+        Message(
+            role="assistant",
+            tool_calls=[
+                ToolCall(
+                    id=f"call_{i}",
+                    function=Function(name="search", arguments='{"q": "x"}'),
+                )
+            ],
+        ),
+        {"role": "tool", "content": "result " * 20, "tool_call_id": f"call_{i}"},
+    ]
+
+
+def build_history(turns: int) -> List[Any]:
+    messages: List[Any] = [{"role": "system", "content": "You are a helpful agent."}]
+    for i in range(turns):
+        messages.extend(build_turn(i))
+    return messages
+
+
+async def noop_emit(event, data):
+    json_backend.dumps(data)
+
+
+def bench_baseline(turns: int, repeat: int) -> float:
+    state = State(messages=build_history(turns))
+    start = time.perf_counter()
+    for i in range(repeat):
+        state.messages.extend(build_turn(turns + i))
+        json_backend.dumps(ensure_values_serializable(state))
+    return (time.perf_counter() - start) / repeat
+
+
+async def bench_session(turns: int, repeat: int) -> float:
+    session = Session(socket_id="bench", emit=noop_emit, emit_call=noop_emit)
+    state = State(messages=build_history(turns))
+    await session.send_output_state("agent", "lineage", state)
+    await session.emit_queue.flush()
+    start = time.perf_counter()
+    for i in range(repeat):
+        state.messages.extend(build_turn(turns + i))
+        await session.send_output_state("agent", "lineage", state)
+        # Send it right away rather than on the next flush interval
+        await session.emit_queue.flush()
+    elapsed = (time.perf_counter() - start) / repeat
+    session.delete()
+    return elapsed
+
+
+async def main():
+    repeat = 50
+    print(f"{'turns':>8} {'full walk (ms)':>16} {'session (ms)':>14}")
+    for turns in (10, 50, 100, 250, 500):
+        baseline = bench_baseline(turns, repeat)
+        session = await bench_session(turns, repeat)
+        print(f"{turns:>8} {baseline * 1000:>16.3f} {session * 1000:>14.3f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
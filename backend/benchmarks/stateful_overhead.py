@@ -0,0 +1,77 @@
+"""
+Measure the per call overhead of @stateful compared to the bare function.
+
+Usage: poetry run python benchmarks/stateful_overhead.py
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+# Import the looplit package of this checkout, even when it is not installed
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["LOOPLIT_DEBUG"] = "true"
+
+from looplit.context import init_context
+from looplit.decorators import STATEFUL_FUNCS, stateful
+from looplit.session import Session
+from looplit.state import State
+
+
+async def noop_emit(event, data):
+    pass
+
+
+async def step(state: State) -> State:
+    state.messages[-1] = {"role": "assistant", "content": "ok"}
+    return state
+
+
+def build_state() -> State:
+    return State(
+        messages=[{"role": "user", "content": f"message {i}"} for i in range(20)]
+    )
+
+
+stateful(init_state=State())(step)
+
+
+async def bench_bare(calls: int) -> float:
+    state = build_state()
+    start = time.perf_counter()
+    for _ in range(calls):
+        await step(state)
+    return (time.perf_counter() - start) / calls
+
+
+async def bench_stateful(calls: int) -> float:
+    session = Session(socket_id="bench", emit=noop_emit, emit_call=noop_emit)
+    # Keep every event queued, flushing is not part of the call overhead
+    session.emit_queue.max_pending = calls * 10
+    run = session.start_run("lineage")
+    init_context(session, run)
+    wrapper = STATEFUL_FUNCS["step"]["func"]
+
+    state = build_state()
+    start = time.perf_counter()
+    for _ in range(calls):
+        await wrapper(state)
+    elapsed = (time.perf_counter() - start) / calls
+
+    session.end_run(run)
+    session.delete()
+    return elapsed
+
+
+async def main():
+    calls = 1000
+    bare = await bench_bare(calls)
+    wrapped = await bench_stateful(calls)
+    print(f"bare function:  {bare * 1e6:>10.2f} us/call")
+    print(f"@stateful:      {wrapped * 1e6:>10.2f} us/call")
+    print(f"overhead:       {(wrapped - bare) * 1e6:>10.2f} us/call")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -9,7 +9,11 @@ from looplit.logger import logger
 if env_found:
     logger.info("Loaded .env file")
 
+from looplit.cache import cache_llm_calls
 from looplit.decorators import stateful, tool
+from looplit.loop import loop
 from looplit.state import State
+from looplit.stream import stream
+from looplit.toolbox import Toolbox
 
-__all__ = ["State", "stateful", "tool"]
+__all__ = ["State", "Toolbox", "cache_llm_calls", "loop", "stateful", "stream", "tool"]
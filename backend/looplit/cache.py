@@ -0,0 +1,238 @@
+import functools
+import importlib
+import inspect
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple, TypeVar
+
+from pydantic import BaseModel
+
+from looplit.context import LooplitContextException, get_context
+from looplit.logger import logger
+from looplit.serializer import content_hash, ensure_values_serializable, json_backend
+
+T = TypeVar("T")
+
+# Methods making LLM calls, by attribute path from the client
+LLM_METHODS: Tuple[Tuple[str, ...], ...] = (
+    # OpenAI and AsyncOpenAI
+    ("chat", "completions", "create"),
+    # Anthropic and AsyncAnthropic
+    ("messages", "create"),
+    # Mistral
+    ("chat", "complete"),
+    ("chat", "complete_async"),
+    # litellm, the module is the client
+    ("completion",),
+    ("acompletion",),
+)
+
+
+class LLMCache:
+    """
+    Record the responses of LLM calls so they can be replayed.
+
+    Calls are keyed by a hash of their arguments (model, messages, tools and
+    other params). The least recently used responses are evicted past
+    `max_size`. If a `path` is given, each response is also persisted as a JSON
+    file in that directory and loaded back on start.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_size: int = 1000):
+        self.path = path
+        self.max_size = max_size
+        self._entries: OrderedDict[str, Dict[str, Any]] = OrderedDict()
+        # LLM calls can be made from the worker threads of sync functions
+        self._lock = threading.Lock()
+        if path:
+            os.makedirs(path, exist_ok=True)
+            self._load()
+
+    def _load(self):
+        assert self.path
+        files = [
+            os.path.join(self.path, name)
+            for name in os.listdir(self.path)
+            if name.endswith(".json")
+        ]
+        # Oldest first, to keep the least recently used order
+        for file in sorted(files, key=os.path.getmtime)[-self.max_size :]:
+            try:
+                with open(file, encoding="utf-8") as f:
+                    entry = json_backend.loads(f.read())
+            except Exception as e:
+                logger.warning(f"Could not load cached LLM response {file}: {e}")
+                continue
+            self._entries[os.path.basename(file)[: -len(".json")]] = entry
+
+    def _file(self, key: str) -> str:
+        assert self.path
+        return os.path.join(self.path, f"{key}.json")
+
+    def key(self, method: str, args: tuple, kwargs: Dict[str, Any]) -> str:
+        return content_hash(
+            ensure_values_serializable(
+                {"method": method, "args": list(args), "kwargs": kwargs}
+            )
+        )
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+        if self.path:
+            try:
+                os.utime(self._file(key))
+            except OSError:
+                pass
+        return decode_response(entry)
+
+    def put(self, key: str, response: Any):
+        entry = encode_response(response)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            evicted = []
+            while len(self._entries) > self.max_size:
+                evicted.append(self._entries.popitem(last=False)[0])
+        if self.path:
+            with open(self._file(key), "w", encoding="utf-8") as f:
+                f.write(json_backend.dumps(entry))
+            for evicted_key in evicted:
+                try:
+                    os.remove(self._file(evicted_key))
+                except OSError:
+                    pass
+
+    def clear(self):
+        with self._lock:
+            keys = list(self._entries.keys())
+            self._entries.clear()
+        if self.path:
+            for key in keys:
+                try:
+                    os.remove(self._file(key))
+                except OSError:
+                    pass
+
+
+def encode_response(response: Any) -> Dict[str, Any]:
+    """Serialize a response along with the path of its type, to rebuild it."""
+    if isinstance(response, BaseModel):
+        cls = response.__class__
+        return {
+            "type": f"{cls.__module__}:{cls.__qualname__}",
+            "value": response.model_dump(mode="json", warnings="none"),
+        }
+    return {"type": None, "value": ensure_values_serializable(response)}
+
+
+def decode_response(entry: Dict[str, Any]) -> Any:
+    if not entry["type"]:
+        return entry["value"]
+    module_name, qualname = entry["type"].split(":")
+    cls: Any = importlib.import_module(module_name)
+    for name in qualname.split("."):
+        cls = getattr(cls, name)
+    return cls.model_validate(entry["value"])
+
+
+_llm_cache = LLMCache()
+
+
+def get_llm_cache() -> LLMCache:
+    return _llm_cache
+
+
+def set_llm_cache(cache: LLMCache):
+    global _llm_cache
+    _llm_cache = cache
+
+
+def _should_replay() -> bool:
+    try:
+        run = get_context().run
+    except LooplitContextException:
+        return False
+    return bool(run and run.replay_from_cache)
+
+
+def _cached(method_name: str, method: Callable) -> Callable:
+    def lookup(args, kwargs):
+        # Streamed responses are not cached
+        if kwargs.get("stream"):
+            return None, None
+        cache = get_llm_cache()
+        key = cache.key(method_name, args, kwargs)
+        if _should_replay():
+            try:
+                return key, cache.get(key)
+            except Exception as e:
+                logger.warning(f"Could not replay cached LLM response: {e}")
+        return key, None
+
+    if inspect.iscoroutinefunction(method):
+
+        @functools.wraps(method)
+        async def async_wrapper(*args, **kwargs):
+            key, cached = lookup(args, kwargs)
+            if cached is not None:
+                return cached
+            response = await method(*args, **kwargs)
+            if key:
+                get_llm_cache().put(key, response)
+            return response
+
+        return async_wrapper
+
+    @functools.wraps(method)
+    def sync_wrapper(*args, **kwargs):
+        key, cached = lookup(args, kwargs)
+        if cached is not None:
+            return cached
+        response = method(*args, **kwargs)
+        if key:
+            get_llm_cache().put(key, response)
+        return response
+
+    return sync_wrapper
+
+
+def cache_llm_calls(client: T) -> T:
+    """
+    Record the LLM calls made with a client, to replay them in runs started
+    with "replay from cache".
+
+    Supports the OpenAI, Anthropic and Mistral clients (sync and async) and the
+    litellm module. The client is patched in place and returned.
+
+    Args:
+        client: The LLM client.
+
+    Returns:
+        The same client.
+    """
+
+    if not os.getenv("LOOPLIT_DEBUG"):
+        return client
+
+    patched = False
+    for path in LLM_METHODS:
+        parent: Any = client
+        for name in path[:-1]:
+            parent = getattr(parent, name, None)
+        method = getattr(parent, path[-1], None) if parent is not None else None
+        if not callable(method) or getattr(method, "__looplit_cached__", False):
+            continue
+        wrapper = _cached(".".join(path), method)
+        setattr(wrapper, "__looplit_cached__", True)
+        setattr(parent, path[-1], wrapper)
+        patched = True
+
+    if not patched:
+        logger.warning(f"No LLM call found to cache on {type(client).__name__}.")
+
+    return client
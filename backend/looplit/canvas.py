@@ -1,9 +1,12 @@
-import json
+import functools
 import os
+from typing import Any, Dict, List
 
 from looplit.context import get_context
 from looplit.decorators import tool
+from looplit.loop import loop
 from looplit.state import State
+from looplit.toolbox import Toolbox
 
 SYSTEM_PROMPT = """You are an AI assistant specialized in analyzing and debugging LLM agent outputs. Your purpose is to identify issues in agent reasoning and suggest improvements to prevent similar problems.
 
@@ -51,46 +54,89 @@ async def update_tool_definition(
     return "Tool definition update suggested!"
 
 
-tool_defs = [
-    update_system_prompt.openai_schema,  # type: ignore
-    update_tool_definition.openai_schema,  # type: ignore
-]
+toolbox = Toolbox([update_system_prompt, update_tool_definition])
 
+tool_defs = toolbox.schemas()
 
-async def handle_tool_calls(state: State, tool_calls):
-    for tool_call in tool_calls:
-        if tool_call.function.name == "update_system_prompt":
-            result = await update_system_prompt(
-                **json.loads(tool_call.function.arguments)
-            )
-        elif tool_call.function.name == "update_tool_definition":
-            result = await update_tool_definition(
-                **json.loads(tool_call.function.arguments)
-            )
-        else:
-            continue
 
-        state.messages.append(
-            {"role": "tool", "content": result, "tool_call_id": tool_call.id}
-        )
+CANVAS_MAX_STEPS = 10
+
+_client = None
+
 
+def get_client():
+    """Get the OpenAI client shared by the canvas agent runs."""
+    global _client
+    if _client is None:
+        from openai import AsyncOpenAI
 
-async def canvas_agent(state: State) -> State:
-    from openai import AsyncOpenAI
+        # The client keeps its connections open between calls
+        _client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    return _client
 
-    client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
-    response = await client.chat.completions.create(
+async def canvas_step(state: State, chat_id: str) -> State:
+    """Stream one completion, handling each tool call as soon as it is complete."""
+    session = get_context().session
+
+    stream = await get_client().chat.completions.create(
         model="gpt-4o",
         temperature=0,
         messages=state.messages,
         tools=state.tools,  # type: ignore
+        stream=True,
     )
-    state.messages.append(response.choices[0].message)
-    tool_calls = response.choices[0].message.tool_calls
 
+    content = ""
+    tool_calls: List[Dict[str, Any]] = []
+    # The tool results are appended after the assistant message
+    results: List[Dict[str, Any]] = []
+
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if delta.content:
+            content += delta.content
+        for tool_call in delta.tool_calls or []:
+            if tool_call.index >= len(tool_calls):
+                # The previous tool call is complete, suggest its edit right away
+                if tool_calls:
+                    results.extend(await toolbox.acall(tool_calls[-1:]))
+                tool_calls.append(
+                    {
+                        "id": tool_call.id,
+                        "type": "function",
+                        "function": {"name": "", "arguments": ""},
+                    }
+                )
+            merged = tool_calls[tool_call.index]["function"]
+            if tool_call.function and tool_call.function.name:
+                merged["name"] = tool_call.function.name
+            if tool_call.function and tool_call.function.arguments:
+                merged["arguments"] += tool_call.function.arguments
+        session.stream_delta(
+            func_name="canvas_agent",
+            lineage_id=chat_id,
+            content=delta.content,
+            tool_calls=delta.tool_calls,
+        )
+
+    if tool_calls:
+        results.extend(await toolbox.acall(tool_calls[-1:]))
+    session.end_stream(chat_id)
+
+    message: Dict[str, Any] = {"role": "assistant", "content": content or None}
     if tool_calls:
-        await handle_tool_calls(state, tool_calls)
-        return await canvas_agent(state)
-    else:
-        return state
+        message["tool_calls"] = tool_calls
+    state.messages.append(message)
+    state.messages.extend(results)
+    return state
+
+
+async def canvas_agent(state: State, chat_id: str) -> State:
+    return await loop(
+        functools.partial(canvas_step, chat_id=chat_id),
+        state,
+        max_steps=CANVAS_MAX_STEPS,
+    )
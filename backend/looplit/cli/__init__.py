@@ -1,16 +1,9 @@
 import asyncio
-
-import nest_asyncio
-
-nest_asyncio.apply()
-
-import inspect
+import contextvars
 import os
-import site
-import sys
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
-from importlib import util
-from typing import Any, TypedDict
+from typing import Any, Iterable, Optional, TypedDict
 
 import click
 import socketio
@@ -21,15 +14,29 @@ from fastapi.staticfiles import StaticFiles
 from starlette.middleware.cors import CORSMiddleware
 from watchfiles import awatch
 
+from looplit.cache import LLMCache, set_llm_cache
+from looplit.canvas import SYSTEM_PROMPT, State, canvas_agent, tool_defs
 from looplit.context import init_context
-from looplit.decorators import STATEFUL_FUNCS
+from looplit.decorators import FuncDef, FuncGeneration, get_func_generation
 from looplit.logger import logger
-from looplit.session import Session
-from looplit.canvas import canvas_agent, State, tool_defs, SYSTEM_PROMPT
+from looplit.reloader import ModuleReloader, ReloaderFilter
+from looplit.serializer import json_backend
+from looplit.session import RunCancelledException, Session, session_store
+from looplit.store import SQLiteRunStore, get_run_store, set_run_store
+
+# Longest wait for the changes of a batch, and the quiet period ending it, in ms
+WATCH_DEBOUNCE = 1600
+WATCH_STEP = 100
 
 BACKEND_ROOT = os.path.dirname(os.path.dirname(__file__))
 PACKAGE_ROOT = os.path.dirname(os.path.dirname(BACKEND_ROOT))
 
+# Port of the Vite server serving the UI in development
+VITE_DEV_PORT = 5173
+
+# Number of variants of a batch call running at once, unless set by the client
+DEFAULT_BATCH_CONCURRENCY = 4
+
 
 def get_build_dir(local_target: str, packaged_target: str) -> str:
     """
@@ -81,56 +88,110 @@ def check_file(target: str):
         raise click.BadParameter(f"File does not exist: {target}")
 
 
-def load_module(target: str, force_refresh: bool = False):
-    """Load the specified module."""
-
-    # Get the target's directory
-    target_dir = os.path.dirname(os.path.abspath(target))
-
-    # Add the target's directory to the Python path
-    sys.path.insert(0, target_dir)
+def get_batch_concurrency(value: Any) -> int:
+    """Read the batch concurrency sent by the client, a semaphore needs at least 1."""
+    if not value:
+        return DEFAULT_BATCH_CONCURRENCY
+    try:
+        return max(1, int(value))
+    except (TypeError, ValueError, OverflowError):
+        logger.warning(f"Invalid batch concurrency {value!r}, using the default.")
+        return DEFAULT_BATCH_CONCURRENCY
 
-    if force_refresh:
-        # Get current site packages dirs
-        site_package_dirs = site.getsitepackages()
 
-        # Clear the modules related to the app from sys.modules
-        for module_name, module in list(sys.modules.items()):
-            if (
-                hasattr(module, "__file__")
-                and module.__file__
-                and module.__file__.startswith(target_dir)
-                and not any(module.__file__.startswith(p) for p in site_package_dirs)
-            ):
-                sys.modules.pop(module_name, None)
-
-    spec = util.spec_from_file_location(target, target)
-    if not spec or not spec.loader:
-        return
-
-    module = util.module_from_spec(spec)
-    if not module:
-        return
-
-    spec.loader.exec_module(module)
-
-    sys.modules[target] = module
-
-    # Remove the target's directory from the Python path
-    sys.path.pop(0)
+def get_allowed_origins(host: str, port: int, extra_origins: Iterable[str]):
+    """Origins allowed to call the API, the UI and its dev server by default."""
+    origins = [f"http://{host}:{port}"]
+    for dev_host in ("localhost", "127.0.0.1"):
+        origins.append(f"http://{dev_host}:{port}")
+        origins.append(f"http://{dev_host}:{VITE_DEV_PORT}")
+    origins.extend(extra_origins)
+    # Keep the first occurrence of each origin
+    return list(dict.fromkeys(origins))
 
 
 @click.command()
 @click.argument("target")
 @click.option("--host", default="127.0.0.1", help="The host to run the server on.")
 @click.option("--port", default=8000, help="The port to run the server on.")
-def run(target, host, port):
+@click.option(
+    "--allow-origin",
+    multiple=True,
+    help="Other origin allowed to call the API, e.g. 'http://example.com'. "
+    "Can be repeated.",
+)
+@click.option(
+    "--session-ttl",
+    default=3600,
+    help="Seconds a disconnected session is kept before being deleted.",
+)
+@click.option(
+    "--max-sessions",
+    default=100,
+    help="Maximum number of sessions kept, the least recently used are deleted first.",
+)
+@click.option(
+    "--store",
+    default=None,
+    help="Path of a SQLite database to persist the runs in, e.g. .looplit/runs.db",
+)
+@click.option(
+    "--workers",
+    default=None,
+    type=int,
+    help="Maximum number of sync stateful functions running at once, in worker threads.",
+)
+@click.option(
+    "--llm-cache",
+    default=None,
+    help="Directory to persist the recorded LLM responses in, e.g. .looplit/llm_cache",
+)
+@click.option(
+    "--watch",
+    multiple=True,
+    help="Glob of other files to reload on change, relative to the target's "
+    "directory, e.g. 'prompts/*.txt'. Can be repeated.",
+)
+@click.option(
+    "--watch-exclude",
+    multiple=True,
+    help="Glob of files to never reload on change, relative to the target's "
+    "directory. Can be repeated.",
+)
+def run(
+    target,
+    host,
+    port,
+    allow_origin,
+    session_ttl,
+    max_sessions,
+    store,
+    workers,
+    llm_cache,
+    watch,
+    watch_exclude,
+):
     os.environ["LOOPLIT_DEBUG"] = "true"
 
+    if llm_cache:
+        set_llm_cache(LLMCache(path=llm_cache))
+
+    # Sync stateful functions run here so they do not block the event loop
+    executor = ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix="looplit-worker"
+    )
+
+    if store:
+        set_run_store(SQLiteRunStore(store))
+
+    session_store.ttl = session_ttl
+    session_store.max_sessions = max_sessions
+
     check_file(target)
-    load_module(target)
+    reloader = ModuleReloader(target)
+    reloader.load()
 
-    logger.info(f"Found {len(STATEFUL_FUNCS.keys())} stateful functions.")
+    logger.info(f"Found {len(get_func_generation()['funcs'])} stateful functions.")
 
     @asynccontextmanager
     async def lifespan(app: FastAPI):
@@ -139,33 +200,54 @@ def run(target, host, port):
         watch_task = None
         stop_event = asyncio.Event()
 
+        watch_filter = ReloaderFilter(reloader, include=watch, exclude=watch_exclude)
+
         async def watch_files_for_changes():
-            extensions = [".py"]
-            async for changes in awatch(os.getcwd(), stop_event=stop_event):
-                for change_type, file_path in changes:
-                    file_name = os.path.basename(file_path)
-                    file_ext = os.path.splitext(file_name)[1]
-
-                    if file_ext.lower() in extensions:
-                        logger.info(
-                            f"File {change_type.name}: {file_name}. Reloading..."
+            while not stop_event.is_set():
+                watch_paths = watch_filter.watch_dirs()
+                async for changes in awatch(
+                    *watch_paths,
+                    watch_filter=watch_filter,
+                    recursive=False,
+                    debounce=WATCH_DEBOUNCE,
+                    step=WATCH_STEP,
+                    stop_event=stop_event,
+                ):
+                    try:
+                        # Only changed modules and their dependents are executed again
+                        reloaded = reloader.reload(path for _, path in changes)
+                    except Exception as e:
+                        logger.error(f"Error reloading module: {e}")
+                        continue
+
+                    if reloaded:
+                        # New calls go to the new generation, running ones finish
+                        # on theirs
+                        await sio.emit(
+                            "code_change",
+                            {
+                                "target": target,
+                                "generation": get_func_generation()["generation"],
+                            },
                         )
+                        await sio.emit("stateful_funcs", get_stateful_funcs_payload())
 
-                        # Reload the module if the module name is specified in the config
-                        if target:
-                            try:
-                                load_module(target, force_refresh=True)
-                            except Exception as e:
-                                logger.error(f"Error reloading module: {e}")
-
-                        await sio.emit("code_change", target)
+                    # Watch the directories of the modules imported since
+                    if watch_filter.watch_dirs() != watch_paths:
                         break
 
         watch_task = asyncio.create_task(watch_files_for_changes())
+        sweep_task = asyncio.create_task(session_store.sweep())
 
         try:
             yield
         finally:
+            sweep_task.cancel()
+            for session in list(session_store.by_id.values()):
+                session.cancel_runs()
+            executor.shutdown(wait=False, cancel_futures=True)
+            if run_store := get_run_store():
+                run_store.close()
             try:
                 if watch_task:
                     stop_event.set()
@@ -189,7 +271,9 @@ def run(target, host, port):
     # Create FastAPI app
     app = FastAPI(lifespan=lifespan)
 
-    sio = socketio.AsyncServer(cors_allowed_origins=[], async_mode="asgi")
+    sio = socketio.AsyncServer(
+        cors_allowed_origins=[], async_mode="asgi", json=json_backend
+    )
 
     asgi_app = socketio.ASGIApp(
         socketio_server=sio,
@@ -198,9 +282,10 @@ def run(target, host, port):
 
     app.mount("/ws/socket.io", asgi_app)
 
+    # The API exposes the prompts and states of the runs, only serve it to the UI
     app.add_middleware(
         CORSMiddleware,
-        allow_origins=["*"],
+        allow_origins=get_allowed_origins(host, port, allow_origin),
         allow_credentials=True,
         allow_methods=["*"],
         allow_headers=["*"],
@@ -222,6 +307,38 @@ def run(target, host, port):
     async def pattern():
         return FileResponse(os.path.join(build_dir, "pattern.png"))
 
+    @app.get("/api/sessions")
+    async def sessions():
+        """List the sessions with their estimated memory usage."""
+        return session_store.stats()
+
+    @app.get("/api/lineages")
+    def lineages(
+        func_name: Optional[str] = None,
+        since: Optional[float] = None,
+        limit: int = 100,
+    ):
+        """List the persisted lineages, most recently updated first."""
+        if run_store := get_run_store():
+            return run_store.list_lineages(
+                func_name=func_name, since=since, limit=limit
+            )
+        return []
+
+    @app.get("/api/lineages/{key}/states")
+    def lineage_states(key: str):
+        """Get the persisted output states of a lineage, by its key."""
+        if run_store := get_run_store():
+            return run_store.get_output_states(key)
+        return {"states": [], "bodies": {}}
+
+    @app.get("/api/lineages/{key}/tool_calls")
+    def lineage_tool_calls(key: str):
+        """Get the persisted tool call mappings of the session of a lineage."""
+        if run_store := get_run_store():
+            return run_store.get_tool_call_mappings(key)
+        return []
+
     @app.get("/{full_path:path}")
     async def serve():
         """Serve the UI files."""
@@ -246,6 +363,17 @@ def run(target, host, port):
 
         return True
 
+    @sio.on("disconnect")
+    async def disconnect(sid):
+        if session := Session.get(sid):
+            session.disconnect()
+
+    def get_stateful_funcs_payload():
+        return {
+            name: func_def["init_state"].model_dump()
+            for name, func_def in get_func_generation()["funcs"].items()
+        }
+
     @sio.on("connection_successful")
     async def connection_successful(sid):
         context = init_context(sid)
@@ -253,9 +381,7 @@ def run(target, host, port):
         if context.session.restored:
             return
 
-        payload = {k: v["init_state"].model_dump() for (k, v) in STATEFUL_FUNCS.items()}
-
-        await context.session.send_stateful_funcs(payload)
+        await context.session.send_stateful_funcs(get_stateful_funcs_payload())
 
     @sio.on("set_interrupt")
     async def set_interrupt(sid, interrupt: bool):
@@ -263,39 +389,136 @@ def run(target, host, port):
         context.session.interrupt = interrupt
 
     @sio.on("stop")
-    async def stop(sid):
+    async def stop(sid, lineage_id: Optional[str] = None):
         if session := Session.get(sid):
-            session.call_stack = []
-            for task in session.current_tasks:
-                task.cancel()
+            session.cancel_runs(lineage_id)
+
+    @sio.on("resync_output_state")
+    async def resync_output_state(sid, lineage_id: str):
+        context = init_context(sid)
+        await context.session.resync_output_state(lineage_id)
 
     class CallPayload(TypedDict):
         func_name: str
         lineage_id: str
         state: dict[str, Any]
+        replay_from_cache: Optional[bool]
+        # Resume from the step boundary following the first edited message
+        resume: Optional[bool]
+        # Lineage the edited messages come from, e.g. the one forked, to resume
+        # from its step boundaries
+        resume_from: Optional[str]
+
+    async def execute_run(
+        sid: str,
+        generation: FuncGeneration,
+        func_def: FuncDef,
+        lineage_id: str,
+        state: dict,
+        replay_from_cache: bool = False,
+        resume: bool = False,
+        resume_from: Optional[str] = None,
+    ):
+        """Run a stateful function for a lineage until it returns or is cancelled."""
+        context = init_context(sid)
+        run = context.session.start_run(lineage_id)
+        run.replay_from_cache = replay_from_cache
+        run.generation = generation["generation"]
+        run.func_names = generation["funcs"].keys()
+        if resume or resume_from:
+            run.resume = context.session.find_checkpoint(
+                lineage_id, state.get("messages") or [], source_lineage_id=resume_from
+            )
+        context.run = run
+        func = func_def["func"]
+        input_state = func_def["state_class"](**state)
+
+        # The task copies the current context, including the run. Sync
+        # functions run in the executor with a copy of the context, they stop
+        # at their next stateful call or loop step once the run is cancelled.
+        if func_def["is_async"]:
+            run.task = asyncio.create_task(func(input_state))
+        else:
+            run.task = asyncio.get_running_loop().run_in_executor(
+                executor, contextvars.copy_context().run, func, input_state
+            )
+        run.task.add_done_callback(lambda _: context.session.end_run(run))
+        try:
+            await run.task
+        except (asyncio.CancelledError, RunCancelledException):
+            pass
 
     @sio.on("call_stateful_func")
     async def call_stateful_func(sid, payload: CallPayload):
-        context = init_context(sid)
-
         func_name = payload["func_name"]
-        func_def = STATEFUL_FUNCS.get(func_name)
+        generation = get_func_generation()
+        func_def = generation["funcs"].get(func_name)
         if not func_def:
             logger.warn(f"Could not find stateful func '{func_name}'.")
             return
 
-        context.session.initial_lineage_id = payload["lineage_id"]
-        context.session.call_stack = []
-        func = func_def["func"]
-        StateClass = func_def["init_state"].__class__
-        input_state = StateClass(**payload["state"])
+        await execute_run(
+            sid,
+            generation,
+            func_def,
+            payload["lineage_id"],
+            payload["state"],
+            replay_from_cache=bool(payload.get("replay_from_cache")),
+            resume=bool(payload.get("resume")),
+            resume_from=payload.get("resume_from"),
+        )
 
-        if inspect.iscoroutinefunction(func):
-            task = asyncio.create_task(func(input_state))
-            context.session.current_tasks.append(task)
-            await task
-        else:
-            func(input_state)
+    class Variant(TypedDict):
+        lineage_id: str
+        # Top level state fields replacing the ones of the input state
+        edits: dict[str, Any]
+
+    class BatchCallPayload(TypedDict):
+        func_name: str
+        state: dict[str, Any]
+        variants: list[Variant]
+        concurrency: Optional[int]
+        replay_from_cache: Optional[bool]
+
+    @sio.on("call_stateful_func_batch")
+    async def call_stateful_func_batch(sid, payload: BatchCallPayload):
+        """
+        Run a stateful function on variants of the same input state.
+
+        Each variant is a separate run streaming its output states under its own
+        lineage id. At most `concurrency` variants run at once.
+        """
+        func_name = payload["func_name"]
+        # Every variant runs on the same generation, even if the target is
+        # reloaded while some are waiting for their turn
+        generation = get_func_generation()
+        func_def = generation["funcs"].get(func_name)
+        if not func_def:
+            logger.warn(f"Could not find stateful func '{func_name}'.")
+            return
+
+        semaphore = asyncio.Semaphore(get_batch_concurrency(payload.get("concurrency")))
+
+        async def execute_variant(variant: Variant):
+            async with semaphore:
+                try:
+                    await execute_run(
+                        sid,
+                        generation,
+                        func_def,
+                        variant["lineage_id"],
+                        {**payload["state"], **variant["edits"]},
+                        replay_from_cache=bool(payload.get("replay_from_cache")),
+                    )
+                except Exception as e:
+                    logger.error(f"Failed to run variant: {e}")
+                    Session.require(sid).send_error(
+                        lineage_id=variant["lineage_id"], error=str(e)
+                    )
+
+        await asyncio.gather(
+            *[execute_variant(variant) for variant in payload["variants"]]
+        )
 
     class AiCanvasRequest(TypedDict):
         chat_id: str
@@ -309,9 +532,14 @@ def run(target, host, port):
         chat_id = payload["chat_id"]
         if not chat_id in context.session.chats:
             messages = [
-                {"role": "system", "content": SYSTEM_PROMPT.format(reasoning=payload["state"], flagged=payload["context"])},
-                {"role": "user", "content": payload["message"]}
-                ]
+                {
+                    "role": "system",
+                    "content": SYSTEM_PROMPT.format(
+                        reasoning=payload["state"], flagged=payload["context"]
+                    ),
+                },
+                {"role": "user", "content": payload["message"]},
+            ]
             context.session.chats[chat_id] = State(messages=messages, tools=tool_defs)
         else:
             last_state = context.session.chats[chat_id]
@@ -324,27 +552,19 @@ def run(target, host, port):
 
         try:
             await context.session.canvas_agent_start()
-            context.session.chats[chat_id] = await canvas_agent(context.session.chats[chat_id])
-            await context.session.canvas_agent_end(response=context.session.chats[chat_id].messages[-1].model_dump())
+            context.session.chats[chat_id] = await canvas_agent(
+                context.session.chats[chat_id], chat_id=chat_id
+            )
+            await context.session.canvas_agent_end(
+                response=context.session.chats[chat_id].messages[-1]
+            )
         except Exception as e:
             logger.error("Failed to run canvas agent: " + str(e))
+            context.session.end_stream(chat_id)
             await context.session.canvas_agent_end(error=str(e))
 
-
-    # Start the server
-    async def start():
-        config = uvicorn.Config(
-            app,
-            host=host,
-            port=port,
-        )
-        server = uvicorn.Server(config)
-        await server.serve()
-
-    # Run the asyncio event loop instead of uvloop to enable re entrance
-    asyncio.run(start())
-
-    # uvicorn.run(app, host=host, port=port)
+    # Start the server, with uvloop if it is installed
+    uvicorn.run(app, host=host, port=port)
 
 
 if __name__ == "__main__":
@@ -1,10 +1,10 @@
 import asyncio
 from contextvars import ContextVar
-from typing import Union
+from typing import Optional, Union
 
 from lazify import LazyProxy
 
-from looplit.session import Session
+from looplit.session import Run, Session
 
 
 class LooplitContextException(Exception):
@@ -15,24 +15,30 @@ class LooplitContextException(Exception):
 class LooplitContext:
     loop: asyncio.AbstractEventLoop
     session: Session
+    run: Optional[Run]
 
     def __init__(
         self,
         session: Session,
+        run: Optional[Run] = None,
     ):
         self.loop = asyncio.get_running_loop()
         self.session = session
+        self.run = run
 
 
 context_var: ContextVar[LooplitContext] = ContextVar("looplit")
 
 
-def init_context(session_or_sid: Union[Session, str]) -> LooplitContext:
+def init_context(
+    session_or_sid: Union[Session, str], run: Optional[Run] = None
+) -> LooplitContext:
     if not isinstance(session_or_sid, Session):
         session = Session.require(session_or_sid)
     else:
         session = session_or_sid
-    context = LooplitContext(session)
+    session.touch()
+    context = LooplitContext(session, run)
     context_var.set(context)
     return context
 
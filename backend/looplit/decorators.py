@@ -3,26 +3,59 @@ import inspect
 import os
 from asyncio import CancelledError
 from datetime import datetime
-from typing import Callable, TypedDict, TypeVar, Union, get_type_hints
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Optional,
+    TypedDict,
+    Union,
+    get_type_hints,
+)
 from uuid import uuid4
 
-from pydantic import create_model
-from pydantic.fields import FieldInfo
+from pydantic import BaseModel, create_model
 
-from looplit.context import context
+from looplit.context import LooplitContext, LooplitContextException, get_context
 from looplit.logger import logger
+from looplit.session import Run, RunCancelledException, tool_call_id_var
 from looplit.state import State
-from looplit.utils import FUNCS_TO_TOOL_CALLS, map_tool_calls, run_sync
+from looplit.utils import map_tool_calls
 
 
 class FuncDef(TypedDict):
     func: Callable
     init_state: State
+    state_class: type[State]
+    is_async: bool
 
 
+class FuncGeneration(TypedDict):
+    # Incremented each time the target is loaded again
+    generation: int
+    funcs: dict[str, FuncDef]
+
+
+# Stateful functions registered so far, mutated while the target is loaded
 STATEFUL_FUNCS: dict[str, FuncDef] = {}
 
-FUNCS_TO_LINEAGE_IDS: dict[str, list[str]] = {}
+# Snapshot of the stateful functions at the last load of the target. Runs keep
+# the generation they started with, new runs use the latest.
+_func_generation: FuncGeneration = {"generation": 0, "funcs": {}}
+
+
+def get_func_generation() -> FuncGeneration:
+    return _func_generation
+
+
+def publish_func_generation() -> FuncGeneration:
+    """Start a new generation with the stateful functions registered."""
+    global _func_generation
+    _func_generation = {
+        "generation": _func_generation["generation"] + 1,
+        "funcs": dict(STATEFUL_FUNCS),
+    }
+    return _func_generation
 
 
 def stateful(init_state: State):
@@ -40,195 +73,347 @@ def stateful(init_state: State):
         if not os.getenv("LOOPLIT_DEBUG"):
             return function
 
-        @functools.wraps(function)
-        async def async_wrapper(*args):
-            # Get the parameter names of the function
-            function_params = list(inspect.signature(function).parameters.keys())
+        # Computed once here rather than on every call
+        func_name = function.__name__
+        is_async = inspect.iscoroutinefunction(function)
 
-            # Create a dictionary of parameter names and their corresponding values from *args
-            params_values = {
-                param_name: arg for param_name, arg in zip(function_params, args)
-            }
+        def enter(args) -> tuple[LooplitContext, Run, str, bool]:
+            context = get_context()
+            run = context.run
+            if not run:
+                raise LooplitContextException("Stateful function called outside a run")
+            run.raise_if_cancelled()
 
-            is_root_call = len(context.session.call_stack) == 0
+            is_root_call = len(run.call_stack) == 0
             is_context_switch = (
-                not is_root_call
-                and context.session.call_stack[-1]["func_name"] != function.__name__
+                not is_root_call and run.call_stack[-1]["func_name"] != func_name
             )
 
             lineage_id = (
-                context.session.initial_lineage_id
+                run.lineage_id
                 if is_root_call
                 else str(uuid4())
                 if is_context_switch
-                else context.session.call_stack[-1]["lineage_id"]
+                else run.call_stack[-1]["lineage_id"]
             )
 
             if is_context_switch:
-                if not function.__name__ in FUNCS_TO_LINEAGE_IDS:
-                    FUNCS_TO_LINEAGE_IDS[function.__name__] = []
-                FUNCS_TO_LINEAGE_IDS[function.__name__].append(lineage_id)
+                if tool_call_id := tool_call_id_var.get():
+                    # Only the first stateful call of the tool is its lineage
+                    tool_call_id_var.set(None)
+                    run.tool_call_registry.pair(func_name, tool_call_id, lineage_id)
+                else:
+                    run.tool_call_registry.add_lineage_id(func_name, lineage_id)
 
-            context.session.call_stack.append(
-                {"func_name": function.__name__, "lineage_id": lineage_id}
-            )
+            run.push_call({"func_name": func_name, "lineage_id": lineage_id})
 
             if not is_root_call:
-                await context.session.send_output_state(
-                    func_name=function.__name__,
+                context.session.put_output_state(
+                    func_name=func_name,
                     lineage_id=lineage_id,
-                    state=args[0].copy(deep=True),
+                    state=args[0],
+                    generation=run.generation,
                 )
 
-            if not is_root_call and context.session.interrupt:
-                await context.session.send_interrupt(func_name=function.__name__)
-
-            await context.session.start(func_name=function.__name__)
+            return context, run, lineage_id, is_root_call
 
-            try:
-                map_tool_calls(args[0].messages, STATEFUL_FUNCS.keys())
+        def before_call(context: LooplitContext, run: Run, lineage_id: str, args):
+            context.session.start(func_name=func_name)
+            map_tool_calls(
+                args[0].messages,
+                run.func_names,
+                run.tool_call_registry,
+                run.get_tool_call_index(lineage_id),
+            )
+            context.session.sync_tool_calls(run)
+
+        def after_call(
+            context: LooplitContext,
+            run: Run,
+            lineage_id: str,
+            result: State,
+            start: datetime,
+            end: datetime,
+        ):
+            if not result.metadata:
+                result.metadata = {}
+
+            result.metadata["func_name"] = func_name
+            result.metadata["duration_ms"] = abs((end - start).total_seconds() * 1000)
+            result.metadata["start_time"] = start.isoformat() + "Z"
+            result.metadata["end_time"] = end.isoformat() + "Z"
+
+            context.session.put_output_state(
+                func_name=func_name,
+                lineage_id=lineage_id,
+                state=result,
+                generation=run.generation,
+            )
 
-                await context.session.sync_tool_calls(
-                    FUNCS_TO_TOOL_CALLS, FUNCS_TO_LINEAGE_IDS
-                )
+        def leave(context: LooplitContext, run: Run):
+            run.pop_call()
+            context.session.end(func_name=func_name)
 
-                start = datetime.utcnow()
+        @functools.wraps(function)
+        async def async_wrapper(*args):
+            context, run, lineage_id, is_root_call = enter(args)
 
-                result = function(**params_values)
+            if not is_root_call and context.session.interrupt:
+                await context.session.send_interrupt(func_name=func_name)
 
-                if inspect.iscoroutine(result):
-                    result = await result
+            try:
+                before_call(context, run, lineage_id, args)
 
+                start = datetime.utcnow()
+                result = await function(*args)
                 end = datetime.utcnow()
 
-                if not result.metadata:
-                    result.metadata = {}
-
-                result.metadata["func_name"] = function.__name__
-                result.metadata["duration_ms"] = abs(
-                    (end - start).total_seconds() * 1000
-                )
-                result.metadata["start_time"] = start.isoformat() + "Z"
-                result.metadata["end_time"] = end.isoformat() + "Z"
-
-                await context.session.send_output_state(
-                    func_name=function.__name__,
-                    lineage_id=lineage_id,
-                    state=result.copy(deep=True),
-                )
+                after_call(context, run, lineage_id, result, start, end)
 
                 return result
             except CancelledError:
                 pass
+            except RunCancelledException:
+                # Raised by the helpers checking the run, e.g. ll.stream, it
+                # unwinds the whole call stack of the cancelled run
+                raise
             except Exception as e:
                 logger.exception(e)
-                await context.session.send_error(lineage_id=lineage_id, error=str(e))
+                context.session.send_error(lineage_id=lineage_id, error=str(e))
             finally:
-                if context.session.call_stack:
-                    context.session.call_stack.pop()
-                await context.session.end(func_name=function.__name__)
+                leave(context, run)
 
+        @functools.wraps(function)
         def sync_wrapper(*args):
-            return run_sync(async_wrapper(*args))
+            # Sync functions run in a worker thread, the events are handed over
+            # to the event loop by the session
+            context, run, lineage_id, is_root_call = enter(args)
 
-        wrapper = (
-            async_wrapper if inspect.iscoroutinefunction(function) else sync_wrapper
-        )
+            if not is_root_call and context.session.interrupt:
+                context.session.wait_for_interrupt(func_name=func_name)
+
+            try:
+                before_call(context, run, lineage_id, args)
+
+                start = datetime.utcnow()
+                result = function(*args)
+                end = datetime.utcnow()
+
+                after_call(context, run, lineage_id, result, start, end)
 
-        STATEFUL_FUNCS[function.__name__] = {"func": wrapper, "init_state": init_state}
+                return result
+            except RunCancelledException:
+                # Unwind the whole call stack of the cancelled run
+                raise
+            except Exception as e:
+                logger.exception(e)
+                context.session.send_error(lineage_id=lineage_id, error=str(e))
+            finally:
+                leave(context, run)
+
+        wrapper = async_wrapper if is_async else sync_wrapper
+
+        STATEFUL_FUNCS[func_name] = {
+            "func": wrapper,
+            "init_state": init_state,
+            "state_class": init_state.__class__,
+            "is_async": is_async,
+        }
 
         return wrapper
 
     return decorator
 
 
-F = TypeVar("F", bound=Callable)
+# Build the schema of a tool for a provider from its name, description and
+# JSON schema parameters
+ToolSchemaBuilder = Callable[[str, Optional[str], Dict[str, Any]], Dict[str, Any]]
 
+TOOL_SCHEMA_BUILDERS: Dict[str, ToolSchemaBuilder] = {}
 
-def tool(func_or_ignore_args: Union[Callable, list[str], None] = None) -> Callable:
-    # If called directly with the function
-    if callable(func_or_ignore_args):
-        # Execute decorator logic directly
-        func = func_or_ignore_args
-        annotations = get_type_hints(func)
-        return_type = annotations.pop("return", None)
-
-        params = {}
-        for name, param in inspect.signature(func).parameters.items():
-            default = param.default if param.default != inspect.Parameter.empty else ...
-            if isinstance(default, FieldInfo):
-                params[name] = (param.annotation, default)  # type: ignore
-            else:
-                params[name] = (param.annotation, default)  # type: ignore
 
-        ParamModel = create_model(
-            f"{func.__name__}_params",
-            **params,  # type: ignore
-        )
+def register_tool_schema(provider: str):
+    """
+    Register the tool schema format of a provider.
 
-        openai_schema = {
-            "type": "function",
-            "function": {
-                "name": func.__name__,
-                "description": func.__doc__,
-                "parameters": ParamModel.model_json_schema(),
-            },
-        }
+    The schema is then available as `my_tool.<provider>_schema`.
+    """
 
-        anthropic_schema = {
-            "name": func.__name__,
-            "description": func.__doc__,
-            "input_schema": ParamModel.model_json_schema(),
-        }
+    def decorator(builder: ToolSchemaBuilder) -> ToolSchemaBuilder:
+        TOOL_SCHEMA_BUILDERS[provider] = builder
+        return builder
 
-        func.openai_schema = openai_schema  # type: ignore
-        func.anthropic_schema = anthropic_schema  # type: ignore
+    return decorator
 
-        return func
 
-    # If called with arguments
-    def decorator(func: F) -> F:
-        ignore_args = (
-            func_or_ignore_args if isinstance(func_or_ignore_args, list) else []
+@register_tool_schema("openai")
+@register_tool_schema("mistral")
+def _function_tool_schema(name, description, parameters):
+    return {
+        "type": "function",
+        "function": {
+            "name": name,
+            "description": description,
+            "parameters": parameters,
+        },
+    }
+
+
+@register_tool_schema("anthropic")
+def _anthropic_tool_schema(name, description, parameters):
+    return {
+        "name": name,
+        "description": description,
+        "input_schema": parameters,
+    }
+
+
+# JSON schema keys supported by Gemini function declarations (an OpenAPI subset)
+GEMINI_SCHEMA_KEYS = {
+    "type",
+    "format",
+    "description",
+    "nullable",
+    "enum",
+    "properties",
+    "required",
+    "items",
+    "anyOf",
+    "minItems",
+    "maxItems",
+    "minimum",
+    "maximum",
+}
+
+
+def _to_gemini_schema(
+    schema: Dict[str, Any], defs: Dict[str, Any], seen: tuple = ()
+) -> Dict[str, Any]:
+    """Inline the `$ref`s of a JSON schema and keep the keys Gemini supports."""
+    if "$ref" in schema:
+        ref = schema["$ref"].split("/")[-1]
+        if ref in seen:
+            raise ValueError(f"Recursive model '{ref}' is not supported by Gemini.")
+        return _to_gemini_schema(
+            {**defs[ref], **{k: v for k, v in schema.items() if k != "$ref"}},
+            defs,
+            seen + (ref,),
         )
 
-        annotations = get_type_hints(func)
-        return_type = annotations.pop("return", None)
-
+    # Optional fields are an anyOf with null, Gemini marks them nullable
+    any_of = schema.get("anyOf")
+    if any_of and any(option.get("type") == "null" for option in any_of):
+        options = [option for option in any_of if option.get("type") != "null"]
+        rest = {k: v for k, v in schema.items() if k != "anyOf"}
+        schema = (
+            {**options[0], **rest} if len(options) == 1 else {**rest, "anyOf": options}
+        )
+        schema["nullable"] = True
+
+    converted: Dict[str, Any] = {}
+    for key, value in schema.items():
+        if key not in GEMINI_SCHEMA_KEYS:
+            continue
+        if key == "properties":
+            value = {
+                name: _to_gemini_schema(prop, defs, seen)
+                for name, prop in value.items()
+            }
+        elif key == "items":
+            value = _to_gemini_schema(value, defs, seen)
+        elif key == "anyOf":
+            value = [_to_gemini_schema(option, defs, seen) for option in value]
+        converted[key] = value
+    return converted
+
+
+@register_tool_schema("gemini")
+def _gemini_tool_schema(name, description, parameters):
+    return {
+        "name": name,
+        "description": description,
+        "parameters": _to_gemini_schema(parameters, parameters.get("$defs", {})),
+    }
+
+
+class Tool:
+    """
+    A function usable as a tool by an LLM.
+
+    The parameters model and the schemas are only built when first accessed,
+    then cached.
+    """
+
+    def __init__(self, func: Callable, ignore_args: Optional[list[str]] = None):
+        functools.update_wrapper(self, func)
+        self.func = func
+        self.name = func.__name__
+        self.description = func.__doc__
+        self.ignore_args = ignore_args or []
+        self.is_async = inspect.iscoroutinefunction(func)
+        self._schemas: Dict[str, Dict[str, Any]] = {}
+
+    def __call__(self, *args, **kwargs):
+        return self.func(*args, **kwargs)
+
+    @functools.cached_property
+    def param_model(self) -> type[BaseModel]:
+        annotations = get_type_hints(self.func)
         params = {}
-        for name, param in inspect.signature(func).parameters.items():
-            if name in ignore_args:
+        for name, param in inspect.signature(self.func).parameters.items():
+            if name in self.ignore_args:
                 continue
-
             default = param.default if param.default != inspect.Parameter.empty else ...
-            if isinstance(default, FieldInfo):
-                params[name] = (param.annotation, default)  # type: ignore
-            else:
-                params[name] = (param.annotation, default)  # type: ignore
+            params[name] = (annotations.get(name, Any), default)
 
-        ParamModel = create_model(
-            f"{func.__name__}_params",
+        return create_model(
+            f"{self.name}_params",
             **params,  # type: ignore
         )
 
-        openai_schema = {
-            "type": "function",
-            "function": {
-                "name": func.__name__,
-                "description": func.__doc__,
-                "parameters": ParamModel.model_json_schema(),
-            },
-        }
+    @functools.cached_property
+    def parameters_schema(self) -> Dict[str, Any]:
+        return self.param_model.model_json_schema()
+
+    def schema(self, provider: str) -> Dict[str, Any]:
+        """Get the schema of the tool in the format of a provider."""
+        if provider not in self._schemas:
+            builder = TOOL_SCHEMA_BUILDERS.get(provider)
+            if not builder:
+                raise ValueError(f"Unknown tool schema provider '{provider}'.")
+            self._schemas[provider] = builder(
+                self.name, self.description, self.parameters_schema
+            )
+        return self._schemas[provider]
+
+    def __getattr__(self, name: str):
+        # e.g. openai_schema, anthropic_schema
+        if not name.startswith("_") and name.endswith("_schema"):
+            provider = name[: -len("_schema")]
+            if provider in TOOL_SCHEMA_BUILDERS:
+                return self.schema(provider)
+        raise AttributeError(
+            f"'{type(self).__name__}' object has no attribute '{name}'"
+        )
 
-        anthropic_schema = {
-            "name": func.__name__,
-            "description": func.__doc__,
-            "input_schema": ParamModel.model_json_schema(),
-        }
 
-        func.openai_schema = openai_schema  # type: ignore
-        func.anthropic_schema = anthropic_schema  # type: ignore
+def tool(func_or_ignore_args: Union[Callable, list[str], None] = None) -> Any:
+    """
+    Turn a function into a tool, exposing its schema for each provider.
+
+    Can be used as `@tool` or `@tool(["ignored_arg"])` to leave arguments out of
+    the schema.
+    """
+
+    # If called directly with the function
+    if callable(func_or_ignore_args):
+        return Tool(func_or_ignore_args)
 
-        return func
+    # If called with arguments
+    def decorator(func: Callable) -> Tool:
+        ignore_args = (
+            func_or_ignore_args if isinstance(func_or_ignore_args, list) else []
+        )
+        return Tool(func, ignore_args)
 
     return decorator
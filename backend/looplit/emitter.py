@@ -0,0 +1,88 @@
+import asyncio
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+
+from looplit.logger import logger
+
+
+class EmitQueue:
+    """
+    Buffer the events sent to a client and send them in batches from a writer task.
+
+    Putting an event never blocks. Pending events are flushed every
+    `flush_interval` seconds, or as soon as `batch_size` events are waiting. A
+    batch of several events is sent as a single `batch` event.
+    """
+
+    def __init__(
+        self,
+        emit: Callable[[str, Any], Awaitable],
+        flush_interval: float = 0.005,
+        batch_size: int = 50,
+        max_pending: int = 1000,
+    ):
+        self.emit = emit
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        # Past this number of pending events the client is considered slow
+        self.max_pending = max_pending
+        self.pending: List[Tuple[str, Any]] = []
+        self._lock: Optional[asyncio.Lock] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._writer: Optional[asyncio.Task] = None
+
+    @property
+    def overloaded(self) -> bool:
+        return len(self.pending) >= self.max_pending
+
+    def put(self, event: str, data: Any):
+        self.pending.append((event, data))
+        self._ensure_writer()
+        if self._wakeup:
+            self._wakeup.set()
+
+    def discard(self, predicate: Callable[[str, Any], bool]) -> List[Tuple[str, Any]]:
+        """Remove the pending events matching the predicate and return them."""
+        discarded: List[Tuple[str, Any]] = []
+        kept: List[Tuple[str, Any]] = []
+        for event, data in self.pending:
+            (discarded if predicate(event, data) else kept).append((event, data))
+        self.pending = kept
+        return discarded
+
+    async def flush(self):
+        """Send every pending event now."""
+        self._ensure_writer()
+        assert self._lock
+        async with self._lock:
+            while self.pending:
+                batch = self.pending[: self.batch_size]
+                del self.pending[: self.batch_size]
+                if len(batch) == 1:
+                    await self.emit(*batch[0])
+                else:
+                    await self.emit("batch", batch)
+
+    def close(self):
+        if self._writer:
+            self._writer.cancel()
+            self._writer = None
+
+    def _ensure_writer(self):
+        if self._writer and not self._writer.done():
+            return
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._writer = asyncio.create_task(self._write())
+
+    async def _write(self):
+        assert self._wakeup
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            if len(self.pending) < self.batch_size:
+                # Leave some time for more events to come in
+                await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Failed to emit events: {e}")
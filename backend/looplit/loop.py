@@ -0,0 +1,141 @@
+import inspect
+import os
+from typing import Any, Awaitable, Callable, Optional, Tuple, TypeVar, Union
+
+from looplit.context import LooplitContext, LooplitContextException, get_context
+from looplit.logger import logger
+from looplit.state import State
+from looplit.utils import get_field, map_tool_calls
+
+S = TypeVar("S", bound=State)
+
+
+def last_message_is_tool_result(state: State) -> bool:
+    """Continue as long as the LLM has tool results to answer."""
+    return bool(state.messages) and get_field(state.messages[-1], "role") == "tool"
+
+
+def _get_step_context() -> Optional[LooplitContext]:
+    """Get the context if the loop runs inside a stateful function."""
+    if not os.getenv("LOOPLIT_DEBUG"):
+        return None
+    try:
+        context = get_context()
+    except LooplitContextException:
+        return None
+    if not context.run or not context.run.call_stack:
+        return None
+    return context
+
+
+def _start_loop(context: LooplitContext, state: S) -> Tuple[S, int]:
+    """Resume from the checkpoint of the run if any, return the state and step."""
+    run = context.run
+    assert run
+    lineage_id = run.call_stack[-1]["lineage_id"]
+    if run.resume and lineage_id == run.lineage_id:
+        resume, run.resume = run.resume, None
+        state.messages = resume["messages"]
+        logger.info(f"Resuming agent loop from step {resume['step']}.")
+        return state, resume["step"]
+
+    context.session.add_checkpoint(
+        lineage_id,
+        0,
+        context.session.serializer.convert_messages(state.messages),
+        reset=True,
+    )
+    return state, 0
+
+
+def _record_step(context: LooplitContext, state: State, step: int):
+    run = context.run
+    assert run
+    call = run.call_stack[-1]
+    map_tool_calls(
+        state.messages,
+        run.func_names,
+        run.tool_call_registry,
+        run.get_tool_call_index(call["lineage_id"]),
+    )
+    context.session.sync_tool_calls(run)
+    serialized = context.session.put_output_state(
+        func_name=call["func_name"],
+        lineage_id=call["lineage_id"],
+        state=state,
+        generation=run.generation,
+    )
+    context.session.add_checkpoint(call["lineage_id"], step, serialized["messages"])
+
+
+def loop(
+    step: Callable[[S], Union[S, Awaitable[S]]],
+    state: S,
+    should_continue: Callable[[S], bool] = last_message_is_tool_result,
+    max_steps: Optional[int] = None,
+) -> Any:
+    """
+    Run an agent loop, calling `step` with the state until it is done.
+
+    `step` implements a single turn (e.g. one LLM call and its tool calls) and
+    returns the state. Inside a stateful function, the state is sent to the UI
+    after each step without going through the stateful wrapper again, so the
+    loop has a constant overhead per step and no recursion limit.
+
+    The state at each step boundary is kept as a checkpoint, so a run started
+    with `resume` after editing a message skips the steps preceding the edit.
+
+    Args:
+        step (Callable): The function running a single turn, sync or async.
+        state (State): The initial state.
+        should_continue (Callable): Whether to run another step. Defaults to
+            continuing while the last message is a tool result.
+        max_steps (Optional[int]): The maximum number of steps to run.
+
+    Returns:
+        State: The final state, or an awaitable of it if `step` is async.
+    """
+
+    if inspect.iscoroutinefunction(step):
+        return _async_loop(step, state, should_continue, max_steps)
+
+    context = _get_step_context()
+    steps = 0
+    if context:
+        state, steps = _start_loop(context, state)
+    while True:
+        state = step(state)  # type: ignore
+        steps += 1
+        if not should_continue(state):
+            return state
+        if max_steps is not None and steps >= max_steps:
+            logger.warning(f"Agent loop stopped after {max_steps} steps.")
+            return state
+        if context:
+            context.run.raise_if_cancelled()  # type: ignore
+            _record_step(context, state, steps)
+            if context.session.interrupt:
+                context.session.wait_for_interrupt(
+                    func_name=context.run.call_stack[-1]["func_name"]  # type: ignore
+                )
+
+
+async def _async_loop(step, state, should_continue, max_steps):
+    context = _get_step_context()
+    steps = 0
+    if context:
+        state, steps = _start_loop(context, state)
+    while True:
+        state = await step(state)
+        steps += 1
+        if not should_continue(state):
+            return state
+        if max_steps is not None and steps >= max_steps:
+            logger.warning(f"Agent loop stopped after {max_steps} steps.")
+            return state
+        if context:
+            _record_step(context, state, steps)
+            if context.session.interrupt:
+                await context.session.send_interrupt(
+                    func_name=context.run.call_stack[-1]["func_name"]
+                )
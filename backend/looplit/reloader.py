@@ -0,0 +1,275 @@
+import ast
+import fnmatch
+import hashlib
+import os
+import site
+import sys
+import time
+from importlib import util
+from typing import Dict, Iterable, List, Optional, Sequence, Set
+
+from watchfiles import Change, DefaultFilter
+
+from looplit.decorators import STATEFUL_FUNCS, publish_func_generation
+from looplit.logger import logger
+
+
+def load_module(target: str):
+    """Load the specified module."""
+
+    # Get the target's directory
+    target_dir = os.path.dirname(os.path.abspath(target))
+
+    # Add the target's directory to the Python path
+    sys.path.insert(0, target_dir)
+
+    try:
+        spec = util.spec_from_file_location(target, target)
+        if not spec or not spec.loader:
+            return
+
+        module = util.module_from_spec(spec)
+        if not module:
+            return
+
+        spec.loader.exec_module(module)
+
+        sys.modules[target] = module
+    finally:
+        # Remove the target's directory from the Python path
+        sys.path.pop(0)
+
+
+class ModuleReloader:
+    """
+    Reload the target and the local modules it depends on, as they change.
+
+    The import graph of the local modules (the ones under the directory of the
+    target, outside of site-packages) is read from their source. When files
+    change, only the changed modules and the modules importing them, directly
+    or not, are executed again. The other modules stay imported, keeping their
+    tools and cached schemas. Files whose content did not change, e.g. touched
+    or saved as is, are ignored.
+
+    Each successful load publishes a new generation of the stateful functions.
+    If a reload fails, the previous generation keeps serving the calls.
+    """
+
+    def __init__(self, target: str):
+        self.target = target
+        self.target_path = os.path.abspath(target)
+        self.root = os.path.dirname(self.target_path)
+        # Local module names by file path
+        self.modules: Dict[str, str] = {}
+        # Local files importing each local file
+        self.importers: Dict[str, Set[str]] = {}
+        # Content hash of the files seen, by file path
+        self.hashes: Dict[str, Optional[str]] = {}
+
+    def load(self):
+        load_module(self.target)
+        self.scan()
+        publish_func_generation()
+
+    def _is_local(self, path: str) -> bool:
+        site_package_dirs = site.getsitepackages() + [site.getusersitepackages()]
+        return path.startswith(self.root + os.sep) and not any(
+            path.startswith(p) for p in site_package_dirs
+        )
+
+    def scan(self):
+        """Rebuild the import graph of the local modules."""
+        self.modules = {self.target_path: self.target}
+        for name, module in list(sys.modules.items()):
+            path = getattr(module, "__file__", None)
+            if path and name != "__main__" and self._is_local(os.path.abspath(path)):
+                self.modules[os.path.abspath(path)] = name
+
+        files_by_name = {name: path for path, name in self.modules.items()}
+        self.importers = {path: set() for path in self.modules}
+        for path, name in self.modules.items():
+            source = self._read(path)
+            for imported in self._imported_names(path, name, source):
+                if imported_path := files_by_name.get(imported):
+                    self.importers[imported_path].add(path)
+
+    def _read(self, path: str) -> Optional[bytes]:
+        """Read a file and keep the hash of its content."""
+        try:
+            with open(path, "rb") as f:
+                source = f.read()
+        except OSError:
+            source = None
+        self.hashes[path] = (
+            hashlib.sha1(source).hexdigest() if source is not None else None
+        )
+        return source
+
+    def _imported_names(
+        self, path: str, module_name: str, source: Optional[bytes]
+    ) -> Set[str]:
+        if source is None:
+            return set()
+        try:
+            tree = ast.parse(source, filename=path)
+        except (SyntaxError, ValueError):
+            return set()
+
+        is_package = os.path.basename(path) == "__init__.py"
+        names: Set[str] = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names.update(alias.name for alias in node.names)
+            elif isinstance(node, ast.ImportFrom):
+                base = node.module or ""
+                if node.level:
+                    package = (
+                        module_name if is_package else module_name.rpartition(".")[0]
+                    )
+                    for _ in range(node.level - 1):
+                        package = package.rpartition(".")[0]
+                    base = f"{package}.{base}" if base else package
+                names.add(base)
+                # `from package import module`
+                names.update(f"{base}.{alias.name}" for alias in node.names)
+        return names
+
+    def watch_dirs(self) -> List[str]:
+        """Get the directories of the local modules, to watch them."""
+        return sorted({os.path.dirname(path) for path in self.modules})
+
+    def has_changed(self, path: str) -> bool:
+        previous = self.hashes.get(path, "")
+        self._read(path)
+        return self.hashes[path] != previous
+
+    def dependents(self, paths: Iterable[str]) -> Set[str]:
+        """Get the given files and every local file importing them, transitively."""
+        affected = set(paths)
+        queue = list(affected)
+        while queue:
+            for importer in self.importers.get(queue.pop(), ()):
+                if importer not in affected:
+                    affected.add(importer)
+                    queue.append(importer)
+        return affected
+
+    def reload(self, changed_paths: Iterable[str]) -> bool:
+        """
+        Reload the changed files, return if any was.
+
+        Changed files outside of the import graph, e.g. matching the watched
+        globs, only execute the target again.
+        """
+        changed = {
+            path
+            for path in map(os.path.abspath, changed_paths)
+            if self.has_changed(path)
+        }
+        if not changed:
+            return False
+
+        start = time.monotonic()
+        # The target is executed again in any case, to import the others
+        affected = self.dependents(changed) | {self.target_path}
+        names = {self.modules[path] for path in affected if path in self.modules}
+
+        # Functions removed from the reloaded modules should not stay registered.
+        # Only the next generation is affected, runs use a snapshot.
+        for func_name, func_def in list(STATEFUL_FUNCS.items()):
+            if func_def["func"].__module__ in names:
+                del STATEFUL_FUNCS[func_name]
+
+        for name in names:
+            module = sys.modules.pop(name, None)
+            # `from package import module` reads the module from its package
+            # first, which would skip the import of the changed file
+            parent_name, _, child = name.rpartition(".")
+            parent = sys.modules.get(parent_name)
+            if module and parent and getattr(parent, child, None) is module:
+                delattr(parent, child)
+
+        # The target imports the evicted modules again, the others are cached
+        load_module(self.target)
+        self.scan()
+        # Running calls keep the previous generation, until they return
+        generation = publish_func_generation()
+
+        logger.info(
+            f"Reloaded {len(names)} module(s) in "
+            f"{(time.monotonic() - start) * 1000:.0f}ms "
+            f"(generation {generation['generation']})."
+        )
+        return True
+
+
+class ReloaderFilter(DefaultFilter):
+    """
+    Only let through the changes of the files worth reloading.
+
+    By default these are the modules of the import graph of the target. If
+    `include` globs are given, the files matching them are let through too.
+    Files matching the `exclude` globs never are. Globs are matched against the
+    path relative to the directory of the target.
+
+    Only the directories that can hold such files are watched, not the whole
+    tree: the directories of the modules and the literal base directory of each
+    glob, e.g. `prompts` for `prompts/*.txt`. Their subdirectories are watched
+    too if the glob has a directory part, e.g. `prompts/**/*.txt`, apart from
+    the ones ignored by default like `.venv` or `node_modules`.
+    """
+
+    def __init__(
+        self,
+        reloader: ModuleReloader,
+        include: Sequence[str] = (),
+        exclude: Sequence[str] = (),
+    ):
+        super().__init__()
+        self.reloader = reloader
+        self.include = include
+        self.exclude = exclude
+
+    def _glob_dirs(self, pattern: str) -> List[str]:
+        parts = pattern.split("/")
+        literal: List[str] = []
+        for part in parts[:-1]:
+            if any(char in part for char in "*?["):
+                break
+            literal.append(part)
+        base = os.path.join(self.reloader.root, *literal)
+        if not os.path.isdir(base):
+            return []
+        # Only the last part is a file name
+        if len(parts) - len(literal) == 1:
+            return [base]
+
+        dirs = []
+        for directory, subdirs, _ in os.walk(base):
+            dirs.append(directory)
+            subdirs[:] = [
+                subdir
+                for subdir in subdirs
+                if subdir not in self.ignore_dirs
+                and not self._matches(os.path.join(directory, subdir), self.exclude)
+            ]
+        return dirs
+
+    def watch_dirs(self) -> List[str]:
+        """Get the directories to watch, non-recursively."""
+        dirs = set(self.reloader.watch_dirs())
+        for pattern in self.include:
+            dirs.update(self._glob_dirs(pattern))
+        return sorted(dirs)
+
+    def _matches(self, path: str, patterns: Sequence[str]) -> bool:
+        relative_path = os.path.relpath(path, self.reloader.root)
+        return any(fnmatch.fnmatch(relative_path, pattern) for pattern in patterns)
+
+    def __call__(self, change: Change, path: str) -> bool:
+        if not super().__call__(change, path):
+            return False
+        path = os.path.abspath(path)
+        if self._matches(path, self.exclude):
+            return False
+        return path in self.reloader.modules or self._matches(path, self.include)
@@ -0,0 +1,184 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from pydantic import BaseModel
+
+from looplit.state import State
+
+orjson: Any
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def ensure_values_serializable(data):
+    """
+    Recursively ensures that all values in the input (dict or list) are JSON serializable.
+    """
+
+    if isinstance(data, BaseModel):
+        return ensure_values_serializable(data.model_dump(warnings="none"))
+    elif isinstance(data, dict):
+        return {key: ensure_values_serializable(value) for key, value in data.items()}
+    elif isinstance(data, list):
+        return [ensure_values_serializable(item) for item in data]
+    elif isinstance(data, (str, int, float, bool, type(None))):
+        return data
+    elif isinstance(data, (tuple, set)):
+        return ensure_values_serializable(
+            list(data)
+        )  # Convert tuples and sets to lists
+    else:
+        return str(data)  # Fallback: convert other types to string
+
+
+class StateSerializer:
+    """
+    Serialize states, converting each message only once.
+
+    Message histories are append-mostly: the serialized messages of a list are
+    kept by identity, and only the messages appended to it since are converted.
+    The history is converted again from the start when it is a different list
+    or was truncated, but a message mutated in place once serialized is not.
+
+    Pydantic objects found in the messages (e.g. an OpenAI ChatCompletionMessage)
+    are considered immutable once appended and are memoized by identity too, so
+    copying a history does not dump them again.
+    """
+
+    def __init__(self, max_size: int = 10000, max_histories: int = 256):
+        self.max_size = max_size
+        self.max_histories = max_histories
+        # Keep a reference to the object so its id cannot be reused
+        self._cache: OrderedDict[int, Tuple[BaseModel, Any]] = OrderedDict()
+        # Message lists and their serialized messages, by list identity
+        self._histories: OrderedDict[int, Tuple[list, List[Any]]] = OrderedDict()
+        # States can be serialized from the worker threads of sync functions
+        self._lock = threading.Lock()
+
+    def serialize(self, state: State) -> Dict[str, Any]:
+        serialized = ensure_values_serializable(
+            state.model_dump(exclude={"messages"}, warnings="none")
+        )
+        serialized["messages"] = self.convert_messages(state.messages)
+        return serialized
+
+    def convert_messages(self, messages: list) -> List[Any]:
+        """Serialize a message history, converting the appended messages only."""
+        key = id(messages)
+        with self._lock:
+            cached = self._histories.get(key)
+        if cached and cached[0] is messages and len(messages) >= len(cached[1]):
+            converted = cached[1]
+        else:
+            # Different or truncated history, convert it from the start
+            converted = []
+        converted = converted + [
+            self.convert(message) for message in messages[len(converted) :]
+        ]
+
+        with self._lock:
+            self._histories[key] = (messages, converted)
+            self._histories.move_to_end(key)
+            if len(self._histories) > self.max_histories:
+                self._histories.popitem(last=False)
+        # Copied so that callers can mutate it
+        return list(converted)
+
+    def convert(self, data):
+        if isinstance(data, BaseModel):
+            key = id(data)
+            with self._lock:
+                cached = self._cache.get(key)
+                if cached and cached[0] is data:
+                    self._cache.move_to_end(key)
+                    return cached[1]
+
+            value = ensure_values_serializable(data)
+            with self._lock:
+                self._cache[key] = (data, value)
+                if len(self._cache) > self.max_size:
+                    self._cache.popitem(last=False)
+            return value
+        elif isinstance(data, dict):
+            return {key: self.convert(value) for key, value in data.items()}
+        elif isinstance(data, (list, tuple, set)):
+            return [self.convert(item) for item in data]
+        elif isinstance(data, (str, int, float, bool, type(None))):
+            return data
+        else:
+            return str(data)
+
+
+def content_hash(value) -> str:
+    """Hash a serialized value, independently of the order of its keys."""
+    if orjson:
+        encoded = orjson.dumps(
+            value, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS
+        )
+    else:
+        encoded = json.dumps(value, sort_keys=True).encode()
+    return hashlib.sha1(encoded).hexdigest()[:16]
+
+
+class ContentEncoder:
+    """
+    Replace serialized messages and tool definitions by their content hash.
+
+    The body of a hash is only sent the first time the client needs it, the
+    client keeps the bodies it received for the lifetime of its socket.
+    """
+
+    def __init__(self):
+        self.sent: Set[str] = set()
+
+    def encode(
+        self, values: Optional[List[Any]], bodies: Dict[str, Any], resend=False
+    ) -> Optional[List[str]]:
+        """Return the hashes of the values, adding the bodies to send to `bodies`."""
+        if values is None:
+            return None
+
+        hashes = []
+        for value in values:
+            key = content_hash(value)
+            if resend or key not in self.sent:
+                self.sent.add(key)
+                bodies[key] = value
+            hashes.append(key)
+        return hashes
+
+    def forget(self, keys: Iterable[str]):
+        """Send the bodies of these hashes again, their events were dropped."""
+        self.sent.difference_update(keys)
+
+    def reset(self):
+        self.sent = set()
+
+
+class JSONBackend:
+    """
+    JSON module used by the socket server, backed by orjson when it is installed.
+    """
+
+    @staticmethod
+    def dumps(obj, *args, **kwargs) -> str:
+        if orjson:
+            # Coerce non string keys like the json module does
+            return orjson.dumps(
+                obj, default=str, option=orjson.OPT_NON_STR_KEYS
+            ).decode()
+        return json.dumps(obj, *args, **kwargs)
+
+    @staticmethod
+    def loads(s, *args, **kwargs):
+        if orjson:
+            return orjson.loads(s)
+        return json.loads(s, *args, **kwargs)
+
+
+json_backend = JSONBackend()
@@ -1,31 +1,97 @@
 import asyncio
+import time
 import uuid
-from typing import Any, Awaitable, Callable, Dict, List, Literal, Optional, TypedDict
-
-from pydantic import BaseModel
+from collections import OrderedDict
+from contextvars import ContextVar
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Collection,
+    Dict,
+    List,
+    Literal,
+    Optional,
+    Tuple,
+    TypedDict,
+)
 
+from looplit.emitter import EmitQueue
+from looplit.logger import logger
+from looplit.serializer import ContentEncoder, StateSerializer
 from looplit.state import State
+from looplit.store import get_run_store
+from looplit.utils import ToolCallIndex, ToolCallRegistry, estimate_size, get_field
+
+# Number of deltas sent for a lineage before a full state is sent again
+OUTPUT_STATE_KEYFRAME_INTERVAL = 20
+
+# Streamed deltas of a lineage are sent at most once per frame, in seconds
+STREAM_FLUSH_INTERVAL = 1 / 60
+
+# Number of lineages whose last output state and checkpoints are kept, every
+# sub-agent call has its own lineage. The least recently updated are dropped.
+MAX_KEPT_LINEAGES = 256
 
 
-def ensure_values_serializable(data):
+def keep_recent(entries: OrderedDict, key: str, max_size: int = MAX_KEPT_LINEAGES):
+    """Mark an entry as the most recently used and evict the oldest ones."""
+    entries.move_to_end(key)
+    while len(entries) > max_size:
+        entries.popitem(last=False)
+
+
+def diff_states(prev: Dict[str, Any], new: Dict[str, Any]) -> Dict[str, Any]:
     """
-    Recursively ensures that all values in the input (dict or list) are JSON serializable.
+    Compute the delta between two serialized states.
+
+    Messages are treated as an append-mostly list: the delta carries the index of
+    the first message that differs and every message after it. Other fields are
+    only included if their value changed.
+
+    The serializer shares the messages it already serialized, so the unchanged
+    messages are found by identity and only the others are compared by value.
     """
 
-    if isinstance(data, BaseModel):
-        return ensure_values_serializable(data.model_dump(warnings="none"))
-    elif isinstance(data, dict):
-        return {key: ensure_values_serializable(value) for key, value in data.items()}
-    elif isinstance(data, list):
-        return [ensure_values_serializable(item) for item in data]
-    elif isinstance(data, (str, int, float, bool, type(None))):
-        return data
-    elif isinstance(data, (tuple, set)):
-        return ensure_values_serializable(
-            list(data)
-        )  # Convert tuples and sets to lists
-    else:
-        return str(data)  # Fallback: convert other types to string
+    prev_messages = prev.get("messages") or []
+    new_messages = new.get("messages") or []
+
+    messages_start = 0
+    for prev_message, new_message in zip(prev_messages, new_messages):
+        if prev_message is not new_message and prev_message != new_message:
+            break
+        messages_start += 1
+
+    fields = {
+        key: value
+        for key, value in new.items()
+        if key != "messages" and prev.get(key) != value
+    }
+
+    return {
+        "messages_start": messages_start,
+        "messages": new_messages[messages_start:],
+        "fields": fields,
+    }
+
+
+class OutputSnapshot(TypedDict):
+    func_name: str
+    # Generation of the stateful functions that produced the state
+    generation: int
+    # Sequence number of the last output state sent for the lineage
+    seq: int
+    # Number of deltas sent since the last full state
+    deltas: int
+    state: Dict[str, Any]
+
+
+class StreamDelta(TypedDict):
+    func_name: str
+    lineage_id: str
+    content: str
+    # Tool call deltas merged by index
+    tool_calls: Dict[int, Dict[str, Any]]
 
 
 class FuncCall(TypedDict):
@@ -33,11 +99,92 @@ class FuncCall(TypedDict):
     lineage_id: str
 
 
+class LineageCheckpoints(TypedDict):
+    # Serialized messages at the last step boundary
+    messages: List[Any]
+    # Step number and number of messages at each step boundary
+    boundaries: List[Tuple[int, int]]
+
+
+class Checkpoint(TypedDict):
+    step: int
+    messages: List[Any]
+
+
+class RunCancelledException(Exception):
+    def __init__(self, msg="Run cancelled", *args, **kwargs):
+        super().__init__(msg, *args, **kwargs)
+
+
+# Stateful calls in progress in the current task or thread. Concurrent tool
+# calls each get their own copy of the stack.
+call_stack_var: ContextVar[Tuple[FuncCall, ...]] = ContextVar(
+    "looplit_call_stack", default=()
+)
+
+# Id of the tool call being run by a Toolbox in the current task or thread,
+# paired with the lineage of the first stateful function it calls
+tool_call_id_var: ContextVar[Optional[str]] = ContextVar(
+    "looplit_tool_call_id", default=None
+)
+
+
+class Run:
+    """A call of a root stateful function and the state of its call stack."""
+
+    tool_call_indexes: Dict[str, ToolCallIndex]
+    task: Optional[asyncio.Future] = None
+    # Set when the run is cancelled, checked by the sync functions running in
+    # a worker thread since a thread cannot be interrupted
+    cancelled: bool = False
+    # Whether the LLM calls answered before are replayed from the cache
+    replay_from_cache: bool = False
+    # Step boundary the agent loop of the run resumes from
+    resume: Optional[Checkpoint] = None
+    # Generation of the stateful functions the run started with, it keeps
+    # calling them even if the target is reloaded in the meantime
+    generation: int = 0
+    func_names: Collection[str] = ()
+
+    def __init__(self, lineage_id: str, tool_call_registry: ToolCallRegistry):
+        self.lineage_id = lineage_id
+        self.tool_call_indexes = {}
+        self.tool_call_registry = tool_call_registry
+
+    @property
+    def call_stack(self) -> Tuple[FuncCall, ...]:
+        return call_stack_var.get()
+
+    def push_call(self, call: FuncCall):
+        call_stack_var.set(call_stack_var.get() + (call,))
+
+    def pop_call(self):
+        call_stack_var.set(call_stack_var.get()[:-1])
+
+    def get_tool_call_index(self, lineage_id: str) -> ToolCallIndex:
+        if lineage_id not in self.tool_call_indexes:
+            self.tool_call_indexes[lineage_id] = ToolCallIndex()
+        return self.tool_call_indexes[lineage_id]
+
+    def cancel(self):
+        self.cancelled = True
+        if self.task:
+            self.task.cancel()
+
+    def raise_if_cancelled(self):
+        if self.cancelled:
+            raise RunCancelledException()
+
+
 class Session:
-    current_tasks: List[asyncio.Task]
-    call_stack: List[FuncCall]
+    runs: Dict[str, Run]
     chats: dict[str, State]
-    initial_lineage_id: Optional[str] = None
+    output_snapshots: OrderedDict[str, OutputSnapshot]
+    checkpoints: OrderedDict[str, LineageCheckpoints]
+    streams: Dict[str, StreamDelta]
+    serializer: StateSerializer
+    content_encoder: ContentEncoder
+    known_tool_calls: OrderedDict[str, None]
     interrupt: bool = False
 
     def __init__(
@@ -49,39 +196,92 @@ class Session:
         emit_call: Callable[[Literal["interrupt"], Any], Awaitable],
     ):
         self.id = str(uuid.uuid4())
-        self.current_tasks = []
-        self.call_stack = []
+        self.runs = {}
         self.chats = {}
+        self.output_snapshots = OrderedDict()
+        # Sequence number of the last output state sent, shared by the lineages
+        # so it keeps increasing when a lineage is run again
+        self.output_seq = -1
+        self.checkpoints = OrderedDict()
+        # Streamed deltas waiting to be sent, by lineage id
+        self.streams = {}
+        self._stream_flush: Optional[asyncio.TimerHandle] = None
+        self.serializer = StateSerializer()
+        self.content_encoder = ContentEncoder()
+        # Shared by the runs so a tool call is only mapped once per session
+        self.known_tool_calls = OrderedDict()
         self.socket_id = socket_id
         self.emit_call = emit_call
         self.emit = emit
+        # Resolve self.emit lazily since it is replaced when the session is restored
+        self.emit_queue = EmitQueue(lambda event, data: self.emit(event, data))
+        # Sync stateful functions run in worker threads and hand their events
+        # over to the event loop the session was created on
+        try:
+            self.loop: Optional[asyncio.AbstractEventLoop] = asyncio.get_running_loop()
+        except RuntimeError:
+            self.loop = None
 
         self.restored = False
+        self.connected = True
+        self.last_active = time.monotonic()
 
-        sessions_id[self.id] = self
-        sessions_sid[socket_id] = self
+        session_store.add(self)
 
     def restore(self, new_socket_id: str):
         """Associate a new socket id to the session."""
-        sessions_sid.pop(self.socket_id, None)
-        sessions_sid[new_socket_id] = self
+        session_store.rebind(self, new_socket_id)
         self.socket_id = new_socket_id
+        # The new socket starts without any message body
+        self.content_encoder.reset()
+        self.connected = True
         self.restored = True
+        self.touch()
+
+    def disconnect(self):
+        """Mark the session as disconnected, it will expire once idle for too long."""
+        self.connected = False
+        self.touch()
 
     def delete(self):
         """Delete the session."""
-        sessions_sid.pop(self.socket_id, None)
-        sessions_id.pop(self.id, None)
+        self.cancel_runs()
+        if self._stream_flush:
+            self._stream_flush.cancel()
+        self.emit_queue.close()
+        session_store.remove(self)
+
+    def touch(self):
+        self.last_active = time.monotonic()
+        session_store.mark_used(self)
+
+    @property
+    def running(self):
+        return bool(self.runs)
+
+    def memory_usage(self) -> int:
+        """Estimate the memory held by the session, in bytes."""
+        return estimate_size(
+            [
+                self.chats,
+                self.output_snapshots,
+                self.checkpoints,
+                self.serializer._cache,
+                self.serializer._histories,
+                self.known_tool_calls,
+                [run.__dict__ for run in self.runs.values()],
+            ]
+        )
 
     @classmethod
     def get(cls, socket_id: str):
         """Get session by socket id."""
-        return sessions_sid.get(socket_id)
+        return session_store.get(socket_id)
 
     @classmethod
     def get_by_id(cls, session_id: str):
         """Get session by session id."""
-        return sessions_id.get(session_id)
+        return session_store.get_by_id(session_id)
 
     @classmethod
     def require(cls, socket_id: str):
@@ -90,54 +290,468 @@ class Session:
             return session
         raise ValueError("Session not found")
 
-    async def start(self, func_name):
-        await self.emit("start", {"name": func_name})
+    def start_run(self, lineage_id: str) -> Run:
+        """Register a new run of a root stateful function for a lineage."""
+        if previous := self.runs.get(lineage_id):
+            previous.cancel()
+
+        run = Run(
+            lineage_id=lineage_id,
+            tool_call_registry=ToolCallRegistry(known_tool_calls=self.known_tool_calls),
+        )
+        self.runs[lineage_id] = run
+        # The client may have appended states to the lineage since the last run
+        self.reset_output_state(lineage_id)
+        return run
+
+    def end_run(self, run: Run):
+        """Release a run once its root stateful function returned."""
+        if self.runs.get(run.lineage_id) is run:
+            del self.runs[run.lineage_id]
+
+    def cancel_runs(self, lineage_id: Optional[str] = None):
+        """Cancel the run of a lineage, or every run if no lineage id is given."""
+        runs = (
+            list(self.runs.values())
+            if lineage_id is None
+            else [run for run in [self.runs.get(lineage_id)] if run]
+        )
+        for run in runs:
+            run.cancel()
 
-    async def end(self, func_name):
-        await self.emit("end", {"name": func_name})
+    def _call_on_loop(self, callback: Callable, *args):
+        """Call `callback` on the event loop, right away if already on it."""
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if self.loop is None or running_loop is self.loop:
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
 
-    async def send_error(self, lineage_id: str, error: str):
-        await self.emit("error", {"lineage_id": lineage_id, "error": error})
+    def _put(self, event: str, data: Any):
+        # The emit queue is only touched from the event loop of the session,
+        # events sent from worker threads (or their own loop) are handed over
+        self._call_on_loop(self.emit_queue.put, event, data)
+
+    def start(self, func_name):
+        self._put("start", {"name": func_name})
+
+    def end(self, func_name):
+        self._put("end", {"name": func_name})
+
+    def send_error(self, lineage_id: str, error: str):
+        self._put("error", {"lineage_id": lineage_id, "error": error})
 
     async def send_interrupt(self, func_name: str):
+        # The client should have every pending event before pausing
+        await self.emit_queue.flush()
         await self.emit_call("interrupt", {"func_name": func_name})
 
+    def wait_for_interrupt(self, func_name: str):
+        """Interrupt from a worker thread, blocking until the client resumes."""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            assert self.loop
+            asyncio.run_coroutine_threadsafe(
+                self.send_interrupt(func_name=func_name), self.loop
+            ).result()
+        else:
+            logger.warning(
+                f"Cannot interrupt {func_name}, sync stateful functions called "
+                "from the event loop are not interruptible."
+            )
+
     async def send_stateful_funcs(self, stateful_funcs: dict[str, object]):
-        await self.emit("stateful_funcs", stateful_funcs)
+        self._put("stateful_funcs", stateful_funcs)
 
-    async def send_output_state(self, func_name: str, lineage_id: str, state: State):
-        state.messages = ensure_values_serializable(state.messages)
-        await self.emit(
-            "output_state",
+    async def send_output_state(
+        self, func_name: str, lineage_id: str, state: State, generation: int = 0
+    ):
+        self.put_output_state(func_name, lineage_id, state, generation)
+
+    def put_output_state(
+        self, func_name: str, lineage_id: str, state: State, generation: int = 0
+    ) -> Dict[str, Any]:
+        """
+        Queue an output state for the client.
+
+        The state is frozen by serializing it, it is never copied nor mutated. The
+        first state of a lineage (and every OUTPUT_STATE_KEYFRAME_INTERVAL states
+        after it) is sent in full, the others as a delta against the previous
+        state sent for the same lineage. Messages and tools are sent as content
+        hashes, along with the bodies the client has not received yet. Each
+        state is tagged with the generation of the stateful functions of its run.
+
+        If the client is too slow to keep up, the states of the lineage still
+        waiting to be sent are replaced by the latest one, in full.
+
+        Can be called from a worker thread: the state is serialized right away
+        and queued from the event loop. Returns the serialized state.
+        """
+        serialized = self.serializer.serialize(state)
+        self._call_on_loop(
+            self._queue_output_state, func_name, lineage_id, serialized, generation
+        )
+        return serialized
+
+    def _queue_output_state(
+        self,
+        func_name: str,
+        lineage_id: str,
+        serialized: Dict[str, Any],
+        generation: int,
+    ):
+        # The state includes the message streamed so far
+        self.streams.pop(lineage_id, None)
+
+        snapshot = self.output_snapshots.get(lineage_id)
+        overloaded = self.emit_queue.overloaded
+
+        if (
+            not snapshot
+            or snapshot["deltas"] >= OUTPUT_STATE_KEYFRAME_INTERVAL
+            or overloaded
+        ):
+            self.output_seq += 1
+            self.output_snapshots[lineage_id] = {
+                "func_name": func_name,
+                "generation": generation,
+                "seq": self.output_seq,
+                "deltas": 0,
+                "state": serialized,
+            }
+            keep_recent(self.output_snapshots, lineage_id)
+            self._persist_output_state(lineage_id)
+            if overloaded:
+                discarded = self.emit_queue.discard(
+                    lambda event, data: event in ("output_state", "output_state_delta")
+                    and data["lineage_id"] == lineage_id
+                )
+                # The client never receives the bodies of the dropped states,
+                # the next states of any lineage send them again
+                for _, data in discarded:
+                    self.content_encoder.forget(data["bodies"])
+            self._put_output_keyframe(lineage_id, resend_bodies=overloaded)
+            return
+
+        delta = diff_states(snapshot["state"], serialized)
+
+        # Share the unchanged messages with the previous snapshot
+        serialized["messages"] = (
+            snapshot["state"]["messages"][: delta["messages_start"]] + delta["messages"]
+        )
+
+        self.output_seq += 1
+        self.output_snapshots[lineage_id] = {
+            "func_name": func_name,
+            "generation": generation,
+            "seq": self.output_seq,
+            "deltas": snapshot["deltas"] + 1,
+            "state": serialized,
+        }
+        keep_recent(self.output_snapshots, lineage_id)
+        self._persist_output_state(lineage_id)
+
+        bodies: Dict[str, Any] = {}
+        delta["messages"] = self.content_encoder.encode(delta["messages"], bodies)
+        if "tools" in delta["fields"]:
+            delta["fields"]["tools"] = self.content_encoder.encode(
+                delta["fields"]["tools"], bodies
+            )
+
+        self.emit_queue.put(
+            "output_state_delta",
             {
                 "func_name": func_name,
+                "generation": generation,
                 "lineage_id": lineage_id,
-                "state": ensure_values_serializable(state),
+                "seq": self.output_seq,
+                "base_seq": snapshot["seq"],
+                "delta": delta,
+                "bodies": bodies,
             },
         )
 
-    async def sync_tool_calls(
+    def _persist_output_state(self, lineage_id: str):
+        if run_store := get_run_store():
+            snapshot = self.output_snapshots[lineage_id]
+            run_store.add_output_state(
+                session_id=self.id,
+                lineage_id=lineage_id,
+                func_name=snapshot["func_name"],
+                seq=snapshot["seq"],
+                state=snapshot["state"],
+            )
+
+    def _put_output_keyframe(self, lineage_id: str, resend_bodies=False):
+        snapshot = self.output_snapshots[lineage_id]
+        state = snapshot["state"]
+
+        bodies: Dict[str, Any] = {}
+        encoded = {
+            **state,
+            "messages": self.content_encoder.encode(
+                state["messages"], bodies, resend=resend_bodies
+            ),
+            "tools": self.content_encoder.encode(
+                state.get("tools"), bodies, resend=resend_bodies
+            ),
+        }
+
+        self.emit_queue.put(
+            "output_state",
+            {
+                "func_name": snapshot["func_name"],
+                "generation": snapshot["generation"],
+                "lineage_id": lineage_id,
+                "seq": snapshot["seq"],
+                "state": encoded,
+                "bodies": bodies,
+            },
+        )
+
+    async def resync_output_state(self, lineage_id: str):
+        """Send the last output state of a lineage in full, on client request."""
+        if snapshot := self.output_snapshots.get(lineage_id):
+            snapshot["deltas"] = 0
+            # The client may have missed some bodies too
+            self._put_output_keyframe(lineage_id, resend_bodies=True)
+
+    def reset_output_state(self, lineage_id: str):
+        """Forget the last output state sent for a lineage."""
+        self.output_snapshots.pop(lineage_id, None)
+
+    def stream_delta(
+        self,
+        func_name: str,
+        lineage_id: str,
+        content: Optional[str] = None,
+        tool_calls: Optional[List[Any]] = None,
+    ):
+        """
+        Stream a delta of the assistant message being generated for a lineage.
+
+        Deltas are merged and sent at most once per STREAM_FLUSH_INTERVAL. Tool
+        call deltas follow the OpenAI format (index, id, function name and
+        arguments), as dicts or objects. Can be called from a worker thread.
+        """
+        self._call_on_loop(
+            self._add_stream_delta, func_name, lineage_id, content, tool_calls
+        )
+
+    def _add_stream_delta(
         self,
-        funcs_to_tool_calls: dict[str, list[str]],
-        funcs_to_lineage_ids: dict[str, list[str]],
+        func_name: str,
+        lineage_id: str,
+        content: Optional[str],
+        tool_calls: Optional[List[Any]],
     ):
-        funcs = funcs_to_tool_calls.keys()
-        for func in funcs:
-            tool_calls = funcs_to_tool_calls.get(func, [])
-            lineage_ids = funcs_to_lineage_ids.get(func, [])
+        pending = self.streams.get(lineage_id)
+        if not pending:
+            pending = self.streams[lineage_id] = {
+                "func_name": func_name,
+                "lineage_id": lineage_id,
+                "content": "",
+                "tool_calls": {},
+            }
+
+        if content:
+            pending["content"] += content
+
+        for tool_call in tool_calls or []:
+            index = get_field(tool_call, "index") or 0
+            merged = pending["tool_calls"].setdefault(
+                index, {"index": index, "id": None, "name": None, "arguments": ""}
+            )
+            if tool_call_id := get_field(tool_call, "id"):
+                merged["id"] = tool_call_id
+            function = get_field(tool_call, "function")
+            if name := get_field(function, "name"):
+                merged["name"] = name
+            if arguments := get_field(function, "arguments"):
+                merged["arguments"] += arguments
+
+        if not self._stream_flush:
+            self._stream_flush = asyncio.get_running_loop().call_later(
+                STREAM_FLUSH_INTERVAL, self._flush_streams
+            )
+
+    def end_stream(self, lineage_id: str):
+        """Drop the streamed message of a lineage, e.g. before streaming a new one."""
+        self._call_on_loop(self._end_stream, lineage_id)
+
+    def _end_stream(self, lineage_id: str):
+        self.streams.pop(lineage_id, None)
+        self.emit_queue.put("output_stream_end", {"lineage_id": lineage_id})
 
-            for tc, lid in zip(tool_calls, lineage_ids):
-                if tc and lid:
-                    await self.emit("map_tc_to_lid", {"tc": tc, "lid": lid})
+    def _flush_streams(self):
+        self._stream_flush = None
+        streams, self.streams = self.streams, {}
+        for pending in streams.values():
+            self.emit_queue.put(
+                "output_stream",
+                {**pending, "tool_calls": list(pending["tool_calls"].values())},
+            )
+
+    def add_checkpoint(
+        self, lineage_id: str, step: int, messages: List[Any], reset=False
+    ):
+        """Record a step boundary of the agent loop of a lineage."""
+        # Loops of sync functions run in worker threads
+        self._call_on_loop(self._add_checkpoint, lineage_id, step, messages, reset)
+
+    def _add_checkpoint(
+        self, lineage_id: str, step: int, messages: List[Any], reset: bool
+    ):
+        checkpoints = self.checkpoints.get(lineage_id)
+        if reset or not checkpoints:
+            checkpoints = self.checkpoints[lineage_id] = {
+                "messages": messages,
+                "boundaries": [],
+            }
+        checkpoints["messages"] = messages
+        checkpoints["boundaries"].append((step, len(messages)))
+        keep_recent(self.checkpoints, lineage_id)
+
+    def find_checkpoint(
+        self,
+        lineage_id: str,
+        messages: List[Any],
+        source_lineage_id: Optional[str] = None,
+    ) -> Optional[Checkpoint]:
+        """
+        Find the step boundary to resume a lineage from, given edited messages.
+
+        The messages are compared with the ones of the last run of the source
+        lineage, the lineage itself by default, or the one it was forked from.
+        The run resumes at the first step boundary following the first edited
+        message, with the edited messages up to that boundary. The steps before
+        it are not run again. Returns None if there is no such boundary.
+        """
+        checkpoints = self.checkpoints.get(source_lineage_id or lineage_id)
+        if not checkpoints or not messages:
+            return None
+
+        edited_at = 0
+        for prev_message, message in zip(checkpoints["messages"], messages):
+            if prev_message != message:
+                break
+            edited_at += 1
+        edited_at = min(edited_at, len(messages) - 1)
+
+        for step, count in checkpoints["boundaries"]:
+            if edited_at < count <= len(messages):
+                # The steps after the boundary will be recorded again. The source
+                # lineage is left as is, other forks can resume from it.
+                self.checkpoints[lineage_id] = {
+                    "messages": messages[:count],
+                    "boundaries": [
+                        boundary
+                        for boundary in checkpoints["boundaries"]
+                        if boundary[0] <= step
+                    ],
+                }
+                keep_recent(self.checkpoints, lineage_id)
+                return {"step": step, "messages": messages[:count]}
+        return None
+
+    def sync_tool_calls(self, run: Run):
+        """Send the new tool call to lineage id mappings of a run, in one event."""
+        if mappings := run.tool_call_registry.pop_mappings():
+            self._put("map_tc_to_lids", mappings)
+            if run_store := get_run_store():
+                run_store.add_tool_call_mappings(self.id, mappings)
 
     async def canvas_agent_start(self):
-        await self.emit("canvas_agent_start", {})
+        self._put("canvas_agent_start", {})
 
     async def canvas_agent_end(self, response=None, error=None):
-        await self.emit("canvas_agent_end", {"response": response, "error": error})
-        
+        self._put("canvas_agent_end", {"response": response, "error": error})
+
     async def send_state_edit(self, old_str: str, new_str: str):
-        await self.emit("state_edit", {"old_str": old_str, "new_str": new_str})
+        self._put("state_edit", {"old_str": old_str, "new_str": new_str})
+
+
+class SessionStore:
+    """
+    Keep track of the sessions by id and socket id.
+
+    Disconnected sessions are kept for `ttl` seconds so the client can restore
+    them, and the least recently used disconnected sessions are evicted when
+    there are more than `max_sessions`. Sessions with a running task are never
+    evicted.
+    """
+
+    def __init__(self, ttl: float = 3600, max_sessions: int = 100):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        # Ordered from the least to the most recently used
+        self.by_id: OrderedDict[str, Session] = OrderedDict()
+        self.by_sid: Dict[str, Session] = {}
+
+    def add(self, session: Session):
+        self.by_id[session.id] = session
+        self.by_sid[session.socket_id] = session
+        self.evict()
+
+    def rebind(self, session: Session, new_socket_id: str):
+        self.by_sid.pop(session.socket_id, None)
+        self.by_sid[new_socket_id] = session
+
+    def remove(self, session: Session):
+        self.by_sid.pop(session.socket_id, None)
+        self.by_id.pop(session.id, None)
+
+    def mark_used(self, session: Session):
+        if session.id in self.by_id:
+            self.by_id.move_to_end(session.id)
+
+    def get(self, socket_id: str) -> Optional[Session]:
+        return self.by_sid.get(socket_id)
+
+    def get_by_id(self, session_id: str) -> Optional[Session]:
+        return self.by_id.get(session_id)
+
+    def evict(self) -> int:
+        """Delete the expired sessions and the extra ones, return how many were deleted."""
+        now = time.monotonic()
+        evictable = [
+            session
+            for session in self.by_id.values()
+            if not session.connected and not session.running
+        ]
+        extra = max(len(self.by_id) - self.max_sessions, 0)
+
+        evicted = 0
+        for session in evictable:
+            if evicted < extra or now - session.last_active > self.ttl:
+                session.delete()
+                evicted += 1
+
+        if evicted:
+            logger.info(f"Evicted {evicted} idle session(s).")
+        return evicted
+
+    async def sweep(self, interval: float = 60):
+        """Evict idle sessions periodically, until cancelled."""
+        while True:
+            await asyncio.sleep(interval)
+            self.evict()
+
+    def stats(self) -> List[Dict[str, Any]]:
+        now = time.monotonic()
+        return [
+            {
+                "connected": session.connected,
+                "running": session.running,
+                "idle_seconds": round(now - session.last_active, 1),
+                "memory_bytes": session.memory_usage(),
+            }
+            for session in self.by_id.values()
+        ]
+
 
-sessions_sid: Dict[str, Session] = {}
-sessions_id: Dict[str, Session] = {}
+session_store = SessionStore()
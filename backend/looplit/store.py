@@ -0,0 +1,341 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from looplit.logger import logger
+from looplit.serializer import content_hash, json_backend
+
+# Messages and tools are stored once in `bodies`, the states reference them by
+# content hash like the output states sent to the client.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS output_states (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    lineage_key TEXT NOT NULL,
+    lineage_id TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    func_name TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    state TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS output_states_lineage ON output_states (lineage_key, id);
+CREATE INDEX IF NOT EXISTS output_states_func ON output_states (func_name, created_at);
+CREATE INDEX IF NOT EXISTS output_states_session ON output_states (session_id, created_at);
+
+CREATE TABLE IF NOT EXISTS bodies (
+    hash TEXT PRIMARY KEY,
+    body TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS tool_call_mappings (
+    tool_call_id TEXT PRIMARY KEY,
+    lineage_id TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tool_call_mappings_session ON tool_call_mappings (session_id);
+"""
+
+# Hashes memoized by message identity, the snapshots of a lineage share the
+# messages they have in common
+MAX_HASHED_BODIES = 4096
+# Hashes known to be in the `bodies` table
+MAX_WRITTEN_BODIES = 65536
+
+
+def lineage_key(session_id: str, lineage_id: str) -> str:
+    """
+    Identify a lineage in the store without exposing the id of its session.
+
+    Lineage ids are only unique within a session, e.g. every root lineage is "root".
+    """
+    return content_hash([session_id, lineage_id])
+
+
+class RunStore(ABC):
+    """
+    Persist the output states and tool call mappings of the runs.
+
+    Writes are called from the event loop and must not block it.
+    """
+
+    @abstractmethod
+    def add_output_state(
+        self,
+        session_id: str,
+        lineage_id: str,
+        func_name: str,
+        seq: int,
+        state: Dict[str, Any],
+    ): ...
+
+    @abstractmethod
+    def add_tool_call_mappings(
+        self, session_id: str, mappings: List[Dict[str, str]]
+    ): ...
+
+    @abstractmethod
+    def list_lineages(
+        self,
+        func_name: Optional[str] = None,
+        since: Optional[float] = None,
+        limit: int = 100,
+    ) -> List[Dict[str, Any]]: ...
+
+    @abstractmethod
+    def get_output_states(self, key: str) -> Dict[str, Any]:
+        """Return the encoded states of a lineage and the bodies they reference."""
+
+    @abstractmethod
+    def get_tool_call_mappings(self, key: str) -> List[Dict[str, str]]:
+        """Return the tool call mappings of the session a lineage ran in."""
+
+    def close(self):
+        pass
+
+
+class SQLiteRunStore(RunStore):
+    """
+    Run store backed by a SQLite database.
+
+    Writes are queued and committed in batches by a background thread, reads
+    open their own connection.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        if directory := os.path.dirname(path):
+            os.makedirs(directory, exist_ok=True)
+
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        conn.close()
+
+        self._queue: queue.Queue = queue.Queue()
+        # Only used by the writer thread
+        self._hashes: OrderedDict[int, Tuple[Any, str]] = OrderedDict()
+        self._written: OrderedDict[str, None] = OrderedDict()
+        self._writer = threading.Thread(
+            target=self._write, name="looplit-run-store", daemon=True
+        )
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def add_output_state(
+        self,
+        session_id: str,
+        lineage_id: str,
+        func_name: str,
+        seq: int,
+        state: Dict[str, Any],
+    ):
+        # The state is a frozen snapshot, it is safe to encode it in the writer thread
+        self._queue.put(
+            (
+                "output_state",
+                (
+                    lineage_key(session_id, lineage_id),
+                    lineage_id,
+                    session_id,
+                    func_name,
+                    seq,
+                    time.time(),
+                    state,
+                ),
+            )
+        )
+
+    def add_tool_call_mappings(self, session_id: str, mappings: List[Dict[str, str]]):
+        now = time.time()
+        for mapping in mappings:
+            self._queue.put(
+                ("tool_call_mapping", (mapping["tc"], mapping["lid"], session_id, now))
+            )
+
+    def _hash(self, value) -> str:
+        # Keep a reference to the value so its id is not reused
+        if cached := self._hashes.get(id(value)):
+            self._hashes.move_to_end(id(value))
+            return cached[1]
+        key = content_hash(value)
+        self._hashes[id(value)] = (value, key)
+        if len(self._hashes) > MAX_HASHED_BODIES:
+            self._hashes.popitem(last=False)
+        return key
+
+    def _encode(self, values: Optional[List[Any]], bodies: Dict[str, Any]):
+        if values is None:
+            return None
+
+        hashes = []
+        for value in values:
+            key = self._hash(value)
+            if key in self._written:
+                self._written.move_to_end(key)
+            else:
+                bodies[key] = value
+            hashes.append(key)
+        return hashes
+
+    def _write_output_state(self, conn: sqlite3.Connection, values: tuple) -> List[str]:
+        *columns, state = values
+        bodies: Dict[str, Any] = {}
+        encoded = {
+            **state,
+            "messages": self._encode(state["messages"], bodies),
+            "tools": self._encode(state.get("tools"), bodies),
+        }
+        conn.executemany(
+            "INSERT OR IGNORE INTO bodies (hash, body) VALUES (?, ?)",
+            [(key, json_backend.dumps(body)) for key, body in bodies.items()],
+        )
+        conn.execute(
+            "INSERT INTO output_states "
+            "(lineage_key, lineage_id, session_id, func_name, seq, created_at, state) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (*columns, json_backend.dumps(encoded)),
+        )
+        return list(bodies)
+
+    def _write(self):
+        conn = self._connect()
+        while True:
+            items = [self._queue.get()]
+            while not self._queue.empty():
+                items.append(self._queue.get_nowait())
+
+            closing = None in items
+            written: List[str] = []
+            try:
+                with conn:
+                    for item in items:
+                        if item is None:
+                            continue
+                        kind, values = item
+                        if kind == "output_state":
+                            written += self._write_output_state(conn, values)
+                        elif kind == "tool_call_mapping":
+                            conn.execute(
+                                "INSERT OR REPLACE INTO tool_call_mappings "
+                                "(tool_call_id, lineage_id, session_id, created_at) "
+                                "VALUES (?, ?, ?, ?)",
+                                values,
+                            )
+            except Exception as e:
+                logger.error(f"Failed to persist runs: {e}")
+            else:
+                # Only skip the bodies once they are committed
+                for key in written:
+                    self._written[key] = None
+                while len(self._written) > MAX_WRITTEN_BODIES:
+                    self._written.popitem(last=False)
+
+            if closing:
+                break
+        conn.close()
+
+    def list_lineages(
+        self,
+        func_name: Optional[str] = None,
+        since: Optional[float] = None,
+        limit: int = 100,
+    ) -> List[Dict[str, Any]]:
+        conditions = []
+        params: List[Any] = []
+        if func_name:
+            conditions.append("func_name = ?")
+            params.append(func_name)
+        if since:
+            conditions.append("created_at >= ?")
+            params.append(since)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT lineage_key AS key, lineage_id, func_name, COUNT(*) AS states, "
+                "MIN(created_at) AS created_at, MAX(created_at) AS updated_at "
+                f"FROM output_states {where} "
+                "GROUP BY lineage_key ORDER BY updated_at DESC LIMIT ?",
+                (*params, limit),
+            ).fetchall()
+        finally:
+            conn.close()
+        return [dict(row) for row in rows]
+
+    def get_output_states(self, key: str) -> Dict[str, Any]:
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT func_name, seq, created_at, state FROM output_states "
+                "WHERE lineage_key = ? ORDER BY id",
+                (key,),
+            ).fetchall()
+            states = [
+                {**dict(row), "state": json_backend.loads(row["state"])} for row in rows
+            ]
+
+            hashes = {
+                h
+                for state in states
+                for field in ("messages", "tools")
+                for h in state["state"].get(field) or []
+            }
+            bodies: Dict[str, Any] = {}
+            for row in conn.execute(
+                "SELECT hash, body FROM bodies WHERE hash IN "
+                "(SELECT value FROM json_each(?))",
+                (json_backend.dumps(list(hashes)),),
+            ):
+                bodies[row["hash"]] = json_backend.loads(row["body"])
+        finally:
+            conn.close()
+        return {"states": states, "bodies": bodies}
+
+    def get_tool_call_mappings(self, key: str) -> List[Dict[str, str]]:
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT tool_call_id AS tc, lineage_id AS lid, session_id "
+                "FROM tool_call_mappings WHERE session_id = "
+                "(SELECT session_id FROM output_states WHERE lineage_key = ? LIMIT 1)",
+                (key,),
+            ).fetchall()
+        finally:
+            conn.close()
+        # The client loads the lineages of the tool calls by their key
+        return [
+            {
+                "tc": row["tc"],
+                "lid": row["lid"],
+                "key": lineage_key(row["session_id"], row["lid"]),
+            }
+            for row in rows
+        ]
+
+    def close(self):
+        """Commit the pending writes and stop the writer thread."""
+        self._queue.put(None)
+        self._writer.join()
+
+
+_run_store: Optional[RunStore] = None
+
+
+def get_run_store() -> Optional[RunStore]:
+    return _run_store
+
+
+def set_run_store(store: Optional[RunStore]):
+    global _run_store
+    _run_store = store
@@ -0,0 +1,39 @@
+import os
+from typing import Any, List, Optional
+
+from looplit.context import LooplitContextException, get_context
+
+
+def stream(content: Optional[str] = None, tool_calls: Optional[List[Any]] = None):
+    """
+    Stream a delta of the assistant message being generated to the UI.
+
+    Call it with each chunk received from the LLM, inside a stateful function.
+    The message is shown as it is generated until the next output state of the
+    function. Stopping the run from the UI raises at the next call.
+
+    Args:
+        content (Optional[str]): The content to append to the message.
+        tool_calls (Optional[List]): The tool call deltas, in the OpenAI format.
+    """
+
+    if not os.getenv("LOOPLIT_DEBUG"):
+        return
+
+    try:
+        context = get_context()
+    except LooplitContextException:
+        return
+
+    run = context.run
+    if not run or not run.call_stack:
+        return
+
+    run.raise_if_cancelled()
+    call = run.call_stack[-1]
+    context.session.stream_delta(
+        func_name=call["func_name"],
+        lineage_id=call["lineage_id"],
+        content=content,
+        tool_calls=tool_calls,
+    )
@@ -0,0 +1,140 @@
+import asyncio
+import contextvars
+import functools
+import json
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from looplit.decorators import Tool
+from looplit.logger import logger
+from looplit.serializer import ensure_values_serializable
+from looplit.session import tool_call_id_var
+from looplit.utils import get_field
+
+
+class Toolbox:
+    """
+    Dispatch the tool calls of an assistant message to their tools.
+
+    Tools are looked up by name and their arguments are validated with the
+    parameters model of the tool, straight from the raw JSON string. The tool
+    calls of a message run concurrently: async tools are gathered and sync tools
+    run in a thread pool. Each call gives a tool message, in the order of the
+    tool calls.
+    """
+
+    def __init__(self, tools: Iterable[Tool], max_workers: Optional[int] = None):
+        self.tools: Dict[str, Tool] = {tool.name: tool for tool in tools}
+        self.max_workers = max_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if not self._executor:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_workers, thread_name_prefix="looplit-tool"
+            )
+        return self._executor
+
+    def schemas(self, provider: str = "openai") -> List[Dict[str, Any]]:
+        """Get the schemas of the tools in the format of a provider."""
+        return [tool.schema(provider) for tool in self.tools.values()]
+
+    def parse(self, tool_call) -> Tuple[Tool, Dict[str, Any]]:
+        """Find the tool of a tool call and validate its arguments."""
+        function = get_field(tool_call, "function")
+        name = get_field(function, "name")
+        tool = self.tools.get(name)
+        if not tool:
+            raise ValueError(f"Unknown tool '{name}'.")
+
+        arguments = get_field(function, "arguments") or "{}"
+        if isinstance(arguments, str):
+            params = tool.param_model.model_validate_json(arguments)
+        else:
+            params = tool.param_model.model_validate(arguments)
+        # Keep the validated values as is, e.g. nested models
+        return tool, {
+            name: getattr(params, name) for name in tool.param_model.model_fields
+        }
+
+    def tool_message(self, tool_call, result=None, error=None) -> Dict[str, Any]:
+        if error is not None:
+            content = f"Error: {error}"
+        elif isinstance(result, str):
+            content = result
+        else:
+            content = json.dumps(ensure_values_serializable(result))
+        return {
+            "role": "tool",
+            "content": content,
+            "tool_call_id": get_field(tool_call, "id"),
+        }
+
+    def _parse_or_reject(self, tool_call):
+        try:
+            return self.parse(tool_call), None
+        except Exception as e:
+            # Sent back to the LLM so it can fix the call
+            logger.warning(f"Invalid tool call: {e}")
+            return None, self.tool_message(tool_call, error=e)
+
+    def _run_sync(self, tool_call) -> Dict[str, Any]:
+        parsed, rejection = self._parse_or_reject(tool_call)
+        if not parsed:
+            return rejection
+        tool, arguments = parsed
+        # Pairs the tool call with the stateful function it calls, if any
+        token = tool_call_id_var.set(get_field(tool_call, "id"))
+        try:
+            if tool.is_async:
+                result = asyncio.run(tool(**arguments))
+            else:
+                result = tool(**arguments)
+        except Exception as e:
+            logger.exception(e)
+            return self.tool_message(tool_call, error=e)
+        finally:
+            tool_call_id_var.reset(token)
+        return self.tool_message(tool_call, result)
+
+    async def _run_async(self, tool_call) -> Dict[str, Any]:
+        parsed, rejection = self._parse_or_reject(tool_call)
+        if not parsed:
+            return rejection
+        tool, arguments = parsed
+        token = tool_call_id_var.set(get_field(tool_call, "id"))
+        try:
+            if tool.is_async:
+                result = await tool(**arguments)
+            else:
+                # Copy the context to the thread, e.g. to call stateful functions
+                result = await asyncio.get_running_loop().run_in_executor(
+                    self.executor,
+                    contextvars.copy_context().run,
+                    functools.partial(tool, **arguments),
+                )
+        except Exception as e:
+            logger.exception(e)
+            return self.tool_message(tool_call, error=e)
+        finally:
+            tool_call_id_var.reset(token)
+        return self.tool_message(tool_call, result)
+
+    def call(self, tool_calls: Optional[List[Any]]) -> List[Dict[str, Any]]:
+        """Run the tool calls concurrently, from sync code."""
+        tool_calls = tool_calls or []
+        if len(tool_calls) <= 1:
+            return [self._run_sync(tool_call) for tool_call in tool_calls]
+
+        futures = [
+            self.executor.submit(contextvars.copy_context().run, self._run_sync, tc)
+            for tc in tool_calls
+        ]
+        return [future.result() for future in futures]
+
+    async def acall(self, tool_calls: Optional[List[Any]]) -> List[Dict[str, Any]]:
+        """Run the tool calls concurrently, from async code."""
+        return await asyncio.gather(
+            *[self._run_async(tool_call) for tool_call in tool_calls or []]
+        )
@@ -1,36 +1,145 @@
-import asyncio
+import os
 import sys
-from typing import Any, Coroutine, TypeVar
+from collections import OrderedDict
+from typing import Optional
 
-from pydantic import BaseModel
 
-T_Retval = TypeVar("T_Retval")
+def estimate_size(obj) -> int:
+    """Roughly estimate the memory held by an object and its content, in bytes."""
+    seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
 
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            stack.extend(item)
+        elif hasattr(item, "__dict__"):
+            stack.append(item.__dict__)
 
-def run_sync(co: Coroutine[Any, Any, T_Retval]) -> T_Retval:
-    """Run the coroutine synchronously."""
+    return size
 
-    loop = asyncio.get_event_loop()
-    result = loop.run_until_complete(co)
-    return result
 
+def get_field(obj, key: str):
+    """Read a field of a message, be it a dict or a pydantic object."""
+    if isinstance(obj, dict):
+        return obj.get(key)
+    return getattr(obj, key, None)
 
-FUNCS_TO_TOOL_CALLS: dict[str, list[str]] = {}
 
+class ToolCallIndex:
+    """
+    Track the tool calls of the last assistant message of a message history.
 
-def map_tool_calls(messages, stateful_func_names):
-    messages = [m.model_dump() if isinstance(m, BaseModel) else m for m in messages]
-    with_tool_calls = [
-        m for m in messages if m["role"] == "assistant" and m["tool_calls"]
-    ]
-    last = with_tool_calls[-1] if with_tool_calls else None
+    Only the messages appended since the last update are inspected.
+    """
 
-    if last:
-        for tool_call in last["tool_calls"]:
-            func_name = tool_call["function"]["name"].removeprefix("call_")
+    def __init__(self):
+        self.messages: Optional[list] = None
+        self.cursor = 0
+        self.last_tool_calls: Optional[list] = None
+
+    def update(self, messages: list) -> Optional[list]:
+        if messages is not self.messages or len(messages) < self.cursor:
+            # Different or truncated history, index it from the start
+            self.messages = messages
+            self.cursor = 0
+            self.last_tool_calls = None
+
+        for message in messages[self.cursor :]:
+            if get_field(message, "role") == "assistant" and (
+                tool_calls := get_field(message, "tool_calls")
+            ):
+                self.last_tool_calls = tool_calls
+
+        self.cursor = len(messages)
+        return self.last_tool_calls
+
+
+class ToolCallRegistry:
+    """
+    Pair the tool calls of a session with the lineages of the stateful functions
+    they called.
+
+    Tool calls run by a Toolbox are paired directly with the lineage they
+    called. The others are paired in order per stateful function. Pairs are
+    dropped once popped, and the ids of the tool calls already seen are kept up
+    to `max_size` so that a tool call replayed in a later state is not paired
+    again. Runs of the same session share their `known_tool_calls`.
+    """
+
+    def __init__(
+        self,
+        max_size: Optional[int] = None,
+        known_tool_calls: Optional[OrderedDict[str, None]] = None,
+    ):
+        self.max_size = max_size or int(os.getenv("LOOPLIT_MAX_TOOL_CALLS", 10000))
+        # Dicts are used as insertion ordered sets
+        self.funcs_to_tool_calls: dict[str, dict[str, None]] = {}
+        self.funcs_to_lineage_ids: dict[str, list[str]] = {}
+        self.mappings: list[dict[str, str]] = []
+        self.known_tool_calls: OrderedDict[str, None] = (
+            OrderedDict() if known_tool_calls is None else known_tool_calls
+        )
+
+    def _add_known_tool_call(self, tool_call_id: str):
+        self.known_tool_calls[tool_call_id] = None
+        if len(self.known_tool_calls) > self.max_size:
+            self.known_tool_calls.popitem(last=False)
+
+    def add_tool_call(self, func_name: str, tool_call_id: str):
+        if tool_call_id in self.known_tool_calls:
+            return
+        self._add_known_tool_call(tool_call_id)
+        self.funcs_to_tool_calls.setdefault(func_name, {})[tool_call_id] = None
+
+    def pair(self, func_name: str, tool_call_id: str, lineage_id: str):
+        """Pair a tool call with the lineage it called, whatever their order."""
+        # The tool call may have been seen in the messages already
+        self.funcs_to_tool_calls.get(func_name, {}).pop(tool_call_id, None)
+        self._add_known_tool_call(tool_call_id)
+        self.mappings.append({"tc": tool_call_id, "lid": lineage_id})
+
+    def add_lineage_id(self, func_name: str, lineage_id: str):
+        self.funcs_to_lineage_ids.setdefault(func_name, []).append(lineage_id)
+
+    def pop_mappings(self) -> list[dict[str, str]]:
+        """Remove and return the tool call to lineage id pairs available."""
+        mappings, self.mappings = self.mappings, []
+        for func_name, tool_calls in self.funcs_to_tool_calls.items():
+            lineage_ids = self.funcs_to_lineage_ids.get(func_name, [])
+            count = min(len(tool_calls), len(lineage_ids))
+            if not count:
+                continue
+
+            paired = list(tool_calls)[:count]
+            for tc, lid in zip(paired, lineage_ids):
+                mappings.append({"tc": tc, "lid": lid})
+                del tool_calls[tc]
+            del lineage_ids[:count]
+
+        return mappings
+
+
+def map_tool_calls(
+    messages,
+    stateful_func_names,
+    registry: ToolCallRegistry,
+    index: Optional[ToolCallIndex] = None,
+):
+    last_tool_calls = (index or ToolCallIndex()).update(messages)
+
+    if last_tool_calls:
+        for tool_call in last_tool_calls:
+            func_name = get_field(
+                get_field(tool_call, "function"), "name"
+            ).removeprefix("call_")
             if func_name in stateful_func_names:
-                if not func_name in FUNCS_TO_TOOL_CALLS:
-                    FUNCS_TO_TOOL_CALLS[func_name] = []
-                elif tool_call["id"] in FUNCS_TO_TOOL_CALLS[func_name]:
-                    continue
-                FUNCS_TO_TOOL_CALLS[func_name].append(tool_call["id"])
+                registry.add_tool_call(func_name, get_field(tool_call, "id"))
@@ -0,0 +1,5 @@
+import os
+
+# Stateful functions and tools are only wrapped in debug mode, which must be
+# set before they are defined
+os.environ["LOOPLIT_DEBUG"] = "true"
@@ -0,0 +1,49 @@
+import pytest
+
+import looplit as ll
+from looplit.context import init_context
+from looplit.decorators import STATEFUL_FUNCS
+from looplit.session import RunCancelledException, Session
+
+
+async def noop_emit(event, data):
+    pass
+
+
+# Positional-only, so it cannot be called with keyword arguments
+@ll.stateful(init_state=ll.State())
+async def positional_agent(state: ll.State, /) -> ll.State:
+    state.messages.append({"role": "assistant", "content": "ok"})
+    return state
+
+
+@ll.stateful(init_state=ll.State())
+async def cancelled_agent(state: ll.State) -> ll.State:
+    raise RunCancelledException()
+
+
+async def test_stateful_passes_args_through():
+    session = Session(socket_id="decorators", emit=noop_emit, emit_call=noop_emit)
+    run = session.start_run("root")
+    init_context(session, run)
+    try:
+        result = await STATEFUL_FUNCS["positional_agent"]["func"](ll.State())
+        assert result.messages == [{"role": "assistant", "content": "ok"}]
+    finally:
+        session.end_run(run)
+        session.emit_queue.close()
+        session.delete()
+
+
+async def test_cancelled_run_is_not_an_error():
+    session = Session(socket_id="cancelled", emit=noop_emit, emit_call=noop_emit)
+    run = session.start_run("root")
+    init_context(session, run)
+    try:
+        with pytest.raises(RunCancelledException):
+            await STATEFUL_FUNCS["cancelled_agent"]["func"](ll.State())
+        assert "error" not in [event for event, _ in session.emit_queue.pending]
+    finally:
+        session.end_run(run)
+        session.emit_queue.close()
+        session.delete()
@@ -0,0 +1,52 @@
+import sys
+
+from looplit.decorators import STATEFUL_FUNCS, get_func_generation
+from looplit.reloader import ModuleReloader
+
+AGENT = """
+import looplit as ll
+
+from reload_pkg import sub
+
+
+@ll.stateful(init_state=ll.State())
+def reload_agent(state: ll.State) -> ll.State:
+    return sub.reload_sub_agent(state)
+"""
+
+SUB = """
+import looplit as ll
+
+
+@ll.stateful(init_state=ll.State())
+def reload_sub_agent(state: ll.State) -> ll.State:
+    return {version}
+"""
+
+
+def test_reload_package_submodule(tmp_path):
+    target = tmp_path / "agent.py"
+    target.write_text(AGENT)
+    (tmp_path / "reload_pkg").mkdir()
+    (tmp_path / "reload_pkg" / "__init__.py").write_text("")
+    sub = tmp_path / "reload_pkg" / "sub.py"
+    sub.write_text(SUB.format(version="state"))
+
+    reloader = ModuleReloader(str(target))
+    try:
+        reloader.load()
+        previous = STATEFUL_FUNCS["reload_sub_agent"]["func"]
+        sub.write_text(SUB.format(version="ll.State()"))
+        assert reloader.reload([str(sub)])
+
+        # The changed submodule is imported again from its cached package
+        assert sys.modules["reload_pkg.sub"].__file__ == str(sub)
+        assert {"reload_agent", "reload_sub_agent"} <= set(
+            get_func_generation()["funcs"]
+        )
+        assert STATEFUL_FUNCS["reload_sub_agent"]["func"] is not previous
+    finally:
+        for name in ["reload_pkg", "reload_pkg.sub", str(target)]:
+            sys.modules.pop(name, None)
+        STATEFUL_FUNCS.pop("reload_agent", None)
+        STATEFUL_FUNCS.pop("reload_sub_agent", None)
@@ -0,0 +1,30 @@
+from looplit.serializer import StateSerializer
+from looplit.state import State
+
+
+def test_serialize_appended_messages_only(monkeypatch):
+    serializer = StateSerializer()
+    converted = []
+    convert = serializer.convert
+
+    def counting_convert(data):
+        # Only count the messages, not their values
+        if isinstance(data, dict):
+            converted.append(data)
+        return convert(data)
+
+    monkeypatch.setattr(serializer, "convert", counting_convert)
+
+    state = State(messages=[{"role": "user", "content": f"{i}"} for i in range(3)])
+    serializer.serialize(state)
+    assert len(converted) == 3
+
+    state.messages.append({"role": "assistant", "content": "3"})
+    assert serializer.serialize(state)["messages"] == state.messages
+    assert converted[3:] == [state.messages[3]]
+
+    # A truncated history is converted from the start
+    del state.messages[2:]
+    converted.clear()
+    assert serializer.serialize(state)["messages"] == state.messages
+    assert len(converted) == 2
@@ -0,0 +1,54 @@
+from looplit.session import Session, diff_states
+from looplit.state import State
+
+
+async def test_overloaded_keyframe_resends_bodies():
+    sent = []
+
+    async def emit(event, data):
+        sent.append((event, data))
+
+    async def emit_call(event, data):
+        pass
+
+    session = Session(socket_id="overloaded", emit=emit, emit_call=emit_call)
+    try:
+        messages = [{"role": "user", "content": "hello"}]
+        session.put_output_state("agent", "root", State(messages=list(messages)))
+
+        # The client is too slow, the pending states are replaced by the last one
+        session.emit_queue.max_pending = 1
+        messages.append({"role": "assistant", "content": "hi"})
+        session.put_output_state("agent", "root", State(messages=list(messages)))
+        await session.emit_queue.flush()
+
+        events = [
+            data
+            for event, data in sent
+            if event in ("output_state", "output_state_delta")
+        ]
+        assert len(events) == 1
+        keyframe = events[0]
+        assert set(keyframe["state"]["messages"]) <= set(keyframe["bodies"])
+    finally:
+        session.emit_queue.close()
+        session.delete()
+
+
+class Unequal(dict):
+    def __eq__(self, other):
+        raise AssertionError("compared by value")
+
+    __ne__ = __eq__
+
+
+def test_diff_states_compares_new_messages_only():
+    shared = [Unequal(role="user", content=f"{i}") for i in range(3)]
+    prev = {"id": "a", "messages": shared + [{"role": "assistant", "content": "x"}]}
+    new = {"id": "b", "messages": shared + [{"role": "assistant", "content": "y"}]}
+
+    assert diff_states(prev, new) == {
+        "messages_start": 3,
+        "messages": [{"role": "assistant", "content": "y"}],
+        "fields": {"id": "b"},
+    }
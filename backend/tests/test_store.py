@@ -0,0 +1,55 @@
+import sqlite3
+
+import pytest
+
+from looplit.store import RunStore, SQLiteRunStore, lineage_key
+
+
+def make_state(messages):
+    return {"id": "state", "messages": messages, "tools": None}
+
+
+def test_output_states_share_bodies(tmp_path):
+    path = str(tmp_path / "runs.db")
+    store = SQLiteRunStore(path)
+
+    messages = [{"role": "user", "content": f"message {i}"} for i in range(3)]
+    for i in range(1, len(messages) + 1):
+        # Like the snapshots, the states share the messages they have in common
+        store.add_output_state("session", "root", "agent", i, make_state(messages[:i]))
+    store.add_output_state("other", "root", "agent", 0, make_state(messages[:1]))
+    store.add_tool_call_mappings("session", [{"tc": "tc0", "lid": "sub"}])
+    store.close()
+
+    conn = sqlite3.connect(path)
+    # Each message is stored once, not once per state
+    assert conn.execute("SELECT COUNT(*) FROM bodies").fetchone() == (3,)
+    conn.close()
+
+    key = lineage_key("session", "root")
+    lineages = store.list_lineages(func_name="agent")
+    # Root lineages of different sessions are not merged
+    assert {lineage["key"] for lineage in lineages} == {
+        key,
+        lineage_key("other", "root"),
+    }
+    assert all("session_id" not in lineage for lineage in lineages)
+
+    persisted = store.get_output_states(key)
+    assert [
+        [persisted["bodies"][h] for h in state["state"]["messages"]]
+        for state in persisted["states"]
+    ] == [messages[:1], messages[:2], messages[:3]]
+
+    assert store.get_tool_call_mappings(key) == [
+        {"tc": "tc0", "lid": "sub", "key": lineage_key("session", "sub")}
+    ]
+
+
+def test_incomplete_store_fails_at_construction():
+    class PartialStore(RunStore):
+        def add_output_state(self, session_id, lineage_id, func_name, seq, state):
+            pass
+
+    with pytest.raises(TypeError):
+        PartialStore()
@@ -0,0 +1,134 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import looplit as ll
+from looplit.context import get_context, init_context
+from looplit.decorators import STATEFUL_FUNCS
+from looplit.session import Session
+
+# Lineage id of each sub-agent call, by query
+lineages_by_query: dict[str, str] = {}
+
+
+def record_lineage(state: ll.State):
+    run = get_context().run
+    assert run
+    lineages_by_query[state.messages[0]["content"]] = run.call_stack[-1]["lineage_id"]
+
+
+@ll.stateful(init_state=ll.State())
+def sync_sub(state: ll.State) -> ll.State:
+    record_lineage(state)
+    return state
+
+
+@ll.stateful(init_state=ll.State())
+async def async_sub(state: ll.State) -> ll.State:
+    record_lineage(state)
+    return state
+
+
+@ll.tool
+def call_sync_sub(query: str, delay: float) -> str:
+    """Ask the sync sub-agent."""
+    # The first tool calls enter the sub-agent last
+    time.sleep(delay)
+    sync_sub(ll.State(messages=[{"role": "user", "content": query}]))
+    return query
+
+
+@ll.tool
+async def call_async_sub(query: str, delay: float) -> str:
+    """Ask the async sub-agent."""
+    await asyncio.sleep(delay)
+    await async_sub(ll.State(messages=[{"role": "user", "content": query}]))
+    return query
+
+
+toolbox = ll.Toolbox([call_sync_sub, call_async_sub])
+
+
+def build_tool_calls(name: str):
+    return [
+        SimpleNamespace(
+            id=f"tc{i}",
+            type="function",
+            function=SimpleNamespace(
+                name=name, arguments=f'{{"query": "q{i}", "delay": {0.3 - i * 0.1}}}'
+            ),
+        )
+        for i in range(3)
+    ]
+
+
+def assistant_message(tool_calls):
+    return {"role": "assistant", "content": None, "tool_calls": tool_calls}
+
+
+def sync_step(state: ll.State) -> ll.State:
+    if state.messages:
+        state.messages.append({"role": "assistant", "content": "done"})
+        return state
+    tool_calls = build_tool_calls("call_sync_sub")
+    state.messages.append(assistant_message(tool_calls))
+    state.messages.extend(toolbox.call(tool_calls))
+    return state
+
+
+async def async_step(state: ll.State) -> ll.State:
+    if state.messages:
+        state.messages.append({"role": "assistant", "content": "done"})
+        return state
+    tool_calls = build_tool_calls("call_async_sub")
+    state.messages.append(assistant_message(tool_calls))
+    state.messages.extend(await toolbox.acall(tool_calls))
+    return state
+
+
+# The tool calls are only seen in the messages at the end of the step, once
+# every sub-agent was called
+@ll.stateful(init_state=ll.State())
+def sync_agent(state: ll.State) -> ll.State:
+    return ll.loop(sync_step, state)
+
+
+@ll.stateful(init_state=ll.State())
+async def async_agent(state: ll.State) -> ll.State:
+    return await ll.loop(async_step, state)
+
+
+async def run_agent(func_name: str) -> dict[str, str]:
+    """Run an agent and return the lineage id mapped to each tool call id."""
+    mappings: dict[str, str] = {}
+
+    async def emit(event, data):
+        events = data if event == "batch" else [(event, data)]
+        for name, payload in events:
+            if name == "map_tc_to_lids":
+                mappings.update({m["tc"]: m["lid"] for m in payload})
+
+    session = Session("sid", emit, emit)
+    run = session.start_run(func_name)
+    run.func_names = STATEFUL_FUNCS.keys()
+    init_context(session, run)
+    lineages_by_query.clear()
+
+    func_def = STATEFUL_FUNCS[func_name]
+    if func_def["is_async"]:
+        await func_def["func"](ll.State(messages=[]))
+    else:
+        await asyncio.to_thread(func_def["func"], ll.State(messages=[]))
+    await session.emit_queue.flush()
+    session.delete()
+    return mappings
+
+
+async def test_concurrent_sync_tools_map_to_their_lineage():
+    mappings = await run_agent("sync_agent")
+    assert mappings == {f"tc{i}": lineages_by_query[f"q{i}"] for i in range(3)}
+
+
+async def test_concurrent_async_tools_map_to_their_lineage():
+    mappings = await run_agent("async_agent")
+    assert mappings == {f"tc{i}": lineages_by_query[f"q{i}"] for i in range(3)}
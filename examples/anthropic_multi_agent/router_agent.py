@@ -1,10 +1,10 @@
-import json
-
 import litellm
 from customer_support_agent import csa_initial_state, customer_support_agent
 
 import looplit as ll
 
+ll.cache_llm_calls(litellm)
+
 
 @ll.tool
 async def get_weather(city: str) -> str:
@@ -21,32 +21,18 @@ async def call_customer_support_agent(query: str) -> str:
     return result.messages[-1].content
 
 
-async def handle_tool_calls(state: ll.State, tool_calls):
-    for tool_call in tool_calls:
-        if tool_call.function.name == "get_weather":
-            result = await get_weather(**json.loads(tool_call.function.arguments))
-        elif tool_call.function.name == "call_customer_support_agent":
-            result = await call_customer_support_agent(
-                **json.loads(tool_call.function.arguments)
-            )
-        else:
-            continue
-
-        state.messages.append(
-            {"role": "tool", "content": result, "tool_call_id": tool_call.id}
-        )
+toolbox = ll.Toolbox([get_weather, call_customer_support_agent])
 
 
 initial_state = ll.State(
     messages=[
         {"role": "system", "content": "Router Agent system prompt."},
     ],
-    tools=[get_weather.openai_schema, call_customer_support_agent.openai_schema],
+    tools=toolbox.schemas(),
 )
 
 
-@ll.stateful(init_state=initial_state)
-async def router_agent(state: ll.State) -> ll.State:
+async def router_step(state: ll.State) -> ll.State:
     response = await litellm.acompletion(
         model="anthropic/claude-3-5-sonnet-20240620",
         max_tokens=1024,
@@ -56,10 +42,13 @@ async def router_agent(state: ll.State) -> ll.State:
     state.messages.append(response.choices[0].message)
     tool_calls = response.choices[0].message.tool_calls
     if tool_calls:
-        await handle_tool_calls(state, tool_calls)
-        return await router_agent(state)
-    else:
-        return state
+        state.messages.extend(await toolbox.acall(tool_calls))
+    return state
+
+
+@ll.stateful(init_state=initial_state)
+async def router_agent(state: ll.State) -> ll.State:
+    return await ll.loop(router_step, state)
 
 
 if __name__ == "__main__":
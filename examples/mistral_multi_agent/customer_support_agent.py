@@ -1,11 +1,10 @@
-import json
 import os
 
 from mistralai import Mistral
 
 import looplit as ll
 
-client = Mistral(api_key=os.getenv("MISTRAL_API_KEY"))
+client = ll.cache_llm_calls(Mistral(api_key=os.getenv("MISTRAL_API_KEY")))
 
 
 @ll.tool
@@ -14,35 +13,18 @@ async def get_order_status(order_id: str) -> str:
     return "in transit"
 
 
-async def handle_tool_calls(state: ll.State, tool_calls):
-    for tool_call in tool_calls:
-        if tool_call.function.name == "get_order_status":
-            result = await get_order_status(**json.loads(tool_call.function.arguments))
-        else:
-            continue
-
-        state.messages.append(
-            {
-                "role": "tool",
-                "content": f"{{'result': {result}}}",
-                "name": tool_call.function.name,
-                "tool_call_id": tool_call.id,
-            }
-        )
+toolbox = ll.Toolbox([get_order_status])
 
 
 csa_initial_state = ll.State(
     messages=[
         {"role": "system", "content": "Customer Support Agent system prompt."},
     ],
-    tools=[
-        get_order_status.openai_schema,
-    ],
+    tools=toolbox.schemas("mistral"),
 )
 
 
-@ll.stateful(init_state=csa_initial_state)
-async def customer_support_agent(state: ll.State) -> ll.State:
+async def customer_support_step(state: ll.State) -> ll.State:
     response = await client.chat.complete_async(
         model="mistral-large-latest",
         temperature=0,
@@ -52,12 +34,14 @@ async def customer_support_agent(state: ll.State) -> ll.State:
 
     state.messages.append(response.choices[0].message)
     tool_calls = response.choices[0].message.tool_calls
-
     if tool_calls:
-        await handle_tool_calls(state, tool_calls)
-        return await customer_support_agent(state)
-    else:
-        return state
+        state.messages.extend(await toolbox.acall(tool_calls))
+    return state
+
+
+@ll.stateful(init_state=csa_initial_state)
+async def customer_support_agent(state: ll.State) -> ll.State:
+    return await ll.loop(customer_support_step, state)
 
 
 if __name__ == "__main__":
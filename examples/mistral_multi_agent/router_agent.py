@@ -1,4 +1,3 @@
-import json
 import os
 
 from customer_support_agent import csa_initial_state, customer_support_agent
@@ -6,7 +5,7 @@ from mistralai import Mistral
 
 import looplit as ll
 
-client = Mistral(api_key=os.getenv("MISTRAL_API_KEY"))
+client = ll.cache_llm_calls(Mistral(api_key=os.getenv("MISTRAL_API_KEY")))
 
 
 @ll.tool
@@ -25,37 +24,18 @@ async def call_customer_support_agent(query: str) -> str:
     return result.messages[-1].content
 
 
-async def handle_tool_calls(state: ll.State, tool_calls):
-    for tool_call in tool_calls:
-        if tool_call.function.name == "get_weather":
-            result = await get_weather(**json.loads(tool_call.function.arguments))
-        elif tool_call.function.name == "call_customer_support_agent":
-            result = await call_customer_support_agent(
-                **json.loads(tool_call.function.arguments)
-            )
-        else:
-            continue
-
-        state.messages.append(
-            {
-                "role": "tool",
-                "content": f"{{'result': {result}}}",
-                "name": tool_call.function.name,
-                "tool_call_id": tool_call.id,
-            }
-        )
+toolbox = ll.Toolbox([get_weather, call_customer_support_agent])
 
 
 initial_state = ll.State(
     messages=[
         {"role": "system", "content": "Router Agent system prompt."},
     ],
-    tools=[get_weather.openai_schema, call_customer_support_agent.openai_schema],
+    tools=toolbox.schemas("mistral"),
 )
 
 
-@ll.stateful(init_state=initial_state)
-async def router_agent(state: ll.State) -> ll.State:
+async def router_step(state: ll.State) -> ll.State:
     response = await client.chat.complete_async(
         model="mistral-large-latest",
         temperature=0,
@@ -65,10 +45,13 @@ async def router_agent(state: ll.State) -> ll.State:
     state.messages.append(response.choices[0].message)
     tool_calls = response.choices[0].message.tool_calls
     if tool_calls:
-        await handle_tool_calls(state, tool_calls)
-        return await router_agent(state)
-    else:
-        return state
+        state.messages.extend(await toolbox.acall(tool_calls))
+    return state
+
+
+@ll.stateful(init_state=initial_state)
+async def router_agent(state: ll.State) -> ll.State:
+    return await ll.loop(router_step, state)
 
 
 if __name__ == "__main__":
@@ -1,15 +1,30 @@
 import { createYamlConflict } from './components/StateMergeEditor';
+import { getServerUrl } from './lib/api';
+import {
+  IBodies,
+  IOutputState,
+  IOutputStateDelta,
+  IStreamDelta,
+  MissingBodyError,
+  applyStateDelta,
+  applyStreamDelta,
+  decodeState,
+  decodeStateDelta
+} from './lib/outputState';
 import {
   IError,
   IInterrupt,
   ILooplitState,
   canvasState,
+  codeGenerationState,
   errorState,
   functionsState,
+  generationByLineageState,
   interruptState,
   runningState,
   sessionState,
   stateHistoryByLineageState,
+  streamingMessageByLineageState,
   toolCallsToLineageIdsState
 } from './state';
 import { useCallback, useEffect } from 'react';
@@ -22,23 +37,22 @@ export default function SocketConnection() {
   const setError = useSetRecoilState(errorState);
   const setCanvas = useSetRecoilState(canvasState);
   const setFunctions = useSetRecoilState(functionsState);
+  const setCodeGeneration = useSetRecoilState(codeGenerationState);
+  const setGenerationByLineage = useSetRecoilState(generationByLineageState);
   const setInterrupt = useSetRecoilState(interruptState);
   const setRunning = useSetRecoilState(runningState);
   const setStateHistoryByLineage = useSetRecoilState(
     stateHistoryByLineageState
   );
+  const setStreamingMessageByLineage = useSetRecoilState(
+    streamingMessageByLineageState
+  );
   const setToolCallsToLineageIds = useSetRecoilState(
     toolCallsToLineageIdsState
   );
 
   const connect = useCallback(() => {
-    const devServer = 'http://127.0.0.1:8000';
-    const { protocol, host } = window.location;
-    const uri = `${protocol}//${host}`;
-
-    const url = import.meta.env.DEV ? devServer : uri;
-
-    const socket = io(url, {
+    const socket = io(getServerUrl(), {
       path: '/ws/socket.io',
       extraHeaders: {}
     });
@@ -60,6 +74,33 @@ export default function SocketConnection() {
       setSession((s) => ({ ...s!, error: true }));
     });
 
+    // Events sent close together are batched by the server
+    socket.on('batch', (events: [string, unknown][]) => {
+      for (const [event, data] of events) {
+        socket.listeners(event).forEach((listener) => listener(data));
+      }
+    });
+
+    const clearStreamingMessage = (lineage_id: string) => {
+      setStreamingMessageByLineage((prev) => {
+        if (!prev[lineage_id]) return prev;
+        const next = { ...prev };
+        delete next[lineage_id];
+        return next;
+      });
+    };
+
+    socket.on('output_stream', (delta: IStreamDelta) => {
+      setStreamingMessageByLineage((prev) => ({
+        ...prev,
+        [delta.lineage_id]: applyStreamDelta(prev[delta.lineage_id], delta)
+      }));
+    });
+
+    socket.on('output_stream_end', ({ lineage_id }: { lineage_id: string }) => {
+      clearStreamingMessage(lineage_id);
+    });
+
     socket.on('stateful_funcs', (funcs: Record<string, ILooplitState>) => {
       setFunctions(funcs);
     });
@@ -70,10 +111,12 @@ export default function SocketConnection() {
 
     socket.on('end', () => {
       setRunning(false);
+      setStreamingMessageByLineage({});
     });
 
     socket.on('error', (error: IError) => {
       setError(error);
+      clearStreamingMessage(error.lineage_id);
     });
 
     socket.on('interrupt', ({ func_name }: IInterrupt, callback) => {
@@ -83,37 +126,131 @@ export default function SocketConnection() {
       });
     });
 
+    // Last state received from the server for each lineage, used as the base for deltas
+    const lastOutputByLineage: Record<
+      string,
+      { seq: number; state: ILooplitState }
+    > = {};
+
+    const pushOutputState = (
+      lineage_id: string,
+      seq: number,
+      generation: number,
+      state: ILooplitState
+    ) => {
+      // A resync can send the last state again, e.g. after several deltas
+      // failed in a row, it replaces the one already in the history
+      const isResent =
+        !!lastOutputByLineage[lineage_id] &&
+        seq <= lastOutputByLineage[lineage_id].seq;
+      lastOutputByLineage[lineage_id] = { seq, state };
+      setGenerationByLineage((prev) =>
+        prev[lineage_id] === generation
+          ? prev
+          : { ...prev, [lineage_id]: generation }
+      );
+      // The state includes the message streamed so far
+      clearStreamingMessage(lineage_id);
+      setStateHistoryByLineage((prev) => {
+        const history = prev[lineage_id] || [];
+        return {
+          ...prev,
+          [lineage_id]:
+            isResent && history.length
+              ? [...history.slice(0, -1), state]
+              : [...history, state]
+        };
+      });
+    };
+
+    // Message and tool bodies received, by content hash
+    const bodies = new Map<string, unknown>();
+
+    const addBodies = (received: IBodies) => {
+      for (const [hash, body] of Object.entries(received)) {
+        bodies.set(hash, body);
+      }
+    };
+
+    const resync = (lineage_id: string) => {
+      socket.emit('resync_output_state', lineage_id);
+    };
+
     socket.on(
       'output_state',
       ({
         lineage_id,
-        state
-      }: {
-        func_name: string;
-        lineage_id: string;
-        state: ILooplitState;
-      }) => {
-        setStateHistoryByLineage((prev) => {
-          return {
-            ...prev,
-            [lineage_id]: prev[lineage_id]
-              ? [...prev[lineage_id], state]
-              : [state]
-          };
-        });
+        seq,
+        generation,
+        state,
+        bodies: received
+      }: IOutputState) => {
+        addBodies(received);
+        try {
+          pushOutputState(
+            lineage_id,
+            seq,
+            generation,
+            decodeState(state, bodies)
+          );
+        } catch (err) {
+          if (!(err instanceof MissingBodyError)) throw err;
+          resync(lineage_id);
+        }
       }
     );
 
-    socket.on('map_tc_to_lid', ({ tc, lid }: { tc: string; lid: string }) => {
-      setToolCallsToLineageIds((prev) => ({
-        ...prev,
-        [tc]: lid
-      }));
-    });
+    socket.on(
+      'output_state_delta',
+      ({
+        lineage_id,
+        seq,
+        base_seq,
+        generation,
+        delta,
+        bodies: received
+      }: IOutputStateDelta) => {
+        addBodies(received);
+        const base = lastOutputByLineage[lineage_id];
+        if (!base || base.seq !== base_seq) {
+          // Missed a state, ask the server for a full one
+          resync(lineage_id);
+          return;
+        }
+        try {
+          pushOutputState(
+            lineage_id,
+            seq,
+            generation,
+            applyStateDelta(base.state, decodeStateDelta(delta, bodies))
+          );
+        } catch (err) {
+          if (!(err instanceof MissingBodyError)) throw err;
+          resync(lineage_id);
+        }
+      }
+    );
 
-    socket.on('code_change', (target: string) => {
-      toast.info(`${target} updated!`);
-    });
+    socket.on(
+      'map_tc_to_lids',
+      (mappings: { tc: string; lid: string }[]) => {
+        setToolCallsToLineageIds((prev) => {
+          const next = { ...prev };
+          for (const { tc, lid } of mappings) {
+            next[tc] = lid;
+          }
+          return next;
+        });
+      }
+    );
+
+    socket.on(
+      'code_change',
+      ({ target, generation }: { target: string; generation: number }) => {
+        setCodeGeneration(generation);
+        toast.info(`${target} updated!`);
+      }
+    );
 
     socket.on('canvas_agent_start', () => {
       setCanvas((prev) => {
@@ -1,15 +1,20 @@
 import CanvasChatAssistantMessage from './AssistantMessage';
 import CanvasChatUserMessage from './UserMessage';
 import { Alert, AlertDescription, AlertTitle } from '@/components/ui/alert';
-import { canvasState } from '@/state';
+import { canvasState, streamingMessageByLineageState } from '@/state';
 import { AlertCircle } from 'lucide-react';
 import { useRecoilValue } from 'recoil';
 
 export default function CanvasChatBody() {
   const canvas = useRecoilValue(canvasState);
+  const streamingMessageByLineage = useRecoilValue(
+    streamingMessageByLineageState
+  );
 
   if (!canvas) return null;
 
+  const streamingMessage = streamingMessageByLineage[canvas.chatId];
+
   return (
     <div className="flex flex-col gap-4 flex-grow px-6 overflow-y-auto">
       {canvas?.messages.map((m, i) => {
@@ -31,6 +36,11 @@ export default function CanvasChatBody() {
           return null;
         }
       })}
+      {canvas.running && streamingMessage?.content ? (
+        <CanvasChatAssistantMessage
+          content={streamingMessage.content as string}
+        />
+      ) : null}
       {canvas.error ? (
         <Alert variant="destructive">
           <AlertCircle className="h-4 w-4" />
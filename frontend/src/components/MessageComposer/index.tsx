@@ -80,7 +80,8 @@ export default function MessageComposer() {
         callStatefulFunction({
           func_name: name,
           lineage_id: currentLineageId,
-          state: newState
+          state: newState,
+          resume: true
         });
       }
     },
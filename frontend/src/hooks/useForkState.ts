@@ -75,7 +75,9 @@ export const useForkState = () => {
         callStatefulFunction({
           func_name: name,
           lineage_id: newLineageId,
-          state: newState
+          state: newState,
+          // Skip the steps preceding the edited message
+          resume_from: currentLineageId
         });
 
         return newLineageId;
@@ -1,4 +1,9 @@
-import { ILooplitState, errorState, sessionState } from '@/state';
+import {
+  ILooplitState,
+  errorState,
+  replayFromCacheState,
+  sessionState
+} from '@/state';
 import { useCallback } from 'react';
 import { useRecoilValue, useSetRecoilState } from 'recoil';
 
@@ -6,6 +11,24 @@ export interface ICallStatefulFunctionPayload {
   func_name: string;
   lineage_id: string;
   state: ILooplitState;
+  // Resume from the step boundary following the first edited message
+  resume?: boolean;
+  // Lineage the state was forked from, to resume from its step boundaries
+  resume_from?: string;
+}
+
+export interface IStateVariant {
+  lineage_id: string;
+  // Top level fields replacing the ones of the input state
+  edits: Partial<ILooplitState> & Record<string, any>;
+}
+
+export interface ICallStatefulFunctionBatchPayload {
+  func_name: string;
+  state: ILooplitState;
+  variants: IStateVariant[];
+  // Maximum number of variants running at once
+  concurrency?: number;
 }
 
 export interface ICallCanvasAgentPayload {
@@ -18,6 +41,7 @@ export interface ICallCanvasAgentPayload {
 export default function useInteraction() {
   const session = useRecoilValue(sessionState);
   const setError = useSetRecoilState(errorState);
+  const replayFromCache = useRecoilValue(replayFromCacheState);
 
   const setInterrupt = useCallback(
     (interrupt: boolean) => {
@@ -29,9 +53,23 @@ export default function useInteraction() {
   const callStatefulFunction = useCallback(
     (payload: ICallStatefulFunctionPayload) => {
       setError(undefined);
-      session?.socket.emit('call_stateful_func', payload);
+      session?.socket.emit('call_stateful_func', {
+        ...payload,
+        replay_from_cache: replayFromCache
+      });
+    },
+    [session?.socket, setError, replayFromCache]
+  );
+
+  const callStatefulFunctionBatch = useCallback(
+    (payload: ICallStatefulFunctionBatchPayload) => {
+      setError(undefined);
+      session?.socket.emit('call_stateful_func_batch', {
+        ...payload,
+        replay_from_cache: replayFromCache
+      });
     },
-    [session?.socket, setError]
+    [session?.socket, setError, replayFromCache]
   );
 
   const callCanvasAgent = useCallback(
@@ -44,6 +82,7 @@ export default function useInteraction() {
   return {
     setInterrupt,
     callStatefulFunction,
+    callStatefulFunctionBatch,
     callCanvasAgent
   };
 }
@@ -0,0 +1,56 @@
+import { IBodies, IEncodedState, decodeState } from './outputState';
+import type { ILooplitState } from '@/state';
+
+// Lineage persisted by the server, identified by its key
+export interface IPersistedLineage {
+  key: string;
+  lineage_id: string;
+  func_name: string;
+  states: number;
+  created_at: number;
+  updated_at: number;
+}
+
+export interface IPersistedToolCall {
+  tc: string;
+  lid: string;
+  // Key of the lineage called by the tool call
+  key: string;
+}
+
+export function getServerUrl() {
+  const devServer = 'http://127.0.0.1:8000';
+  const { protocol, host } = window.location;
+  const uri = `${protocol}//${host}`;
+
+  return import.meta.env.DEV ? devServer : uri;
+}
+
+async function getJson<T>(path: string): Promise<T> {
+  const res = await fetch(`${getServerUrl()}${path}`);
+  if (!res.ok) {
+    throw new Error(`${res.status} ${res.statusText}`);
+  }
+  return res.json();
+}
+
+export function listLineages(funcName: string) {
+  const params = new URLSearchParams({ func_name: funcName });
+  return getJson<IPersistedLineage[]>(`/api/lineages?${params}`);
+}
+
+export async function getLineageStates(key: string): Promise<ILooplitState[]> {
+  const { states, bodies } = await getJson<{
+    states: { state: IEncodedState }[];
+    bodies: IBodies;
+  }>(`/api/lineages/${encodeURIComponent(key)}/states`);
+
+  const resolved = new Map(Object.entries(bodies));
+  return states.map(({ state }) => decodeState(state, resolved));
+}
+
+export function getLineageToolCalls(key: string) {
+  return getJson<IPersistedToolCall[]>(
+    `/api/lineages/${encodeURIComponent(key)}/tool_calls`
+  );
+}
@@ -0,0 +1,140 @@
+import type { IMessage } from '@/components/Message';
+import type { ILooplitState } from '@/state';
+
+// Message and tool bodies by content hash
+export type IBodies = Record<string, unknown>;
+
+export interface IEncodedState
+  extends Omit<ILooplitState, 'messages' | 'tools'> {
+  messages: string[];
+  tools: string[] | null;
+}
+
+export interface IOutputState {
+  func_name: string;
+  // Generation of the stateful functions that produced the state
+  generation: number;
+  lineage_id: string;
+  seq: number;
+  state: IEncodedState;
+  bodies: IBodies;
+}
+
+export interface IStateDelta {
+  messages_start: number;
+  messages: ILooplitState['messages'];
+  fields: Partial<ILooplitState>;
+}
+
+export interface IEncodedStateDelta {
+  messages_start: number;
+  messages: string[];
+  fields: Partial<Omit<IEncodedState, 'messages'>>;
+}
+
+export interface IOutputStateDelta {
+  func_name: string;
+  generation: number;
+  lineage_id: string;
+  seq: number;
+  base_seq: number;
+  delta: IEncodedStateDelta;
+  bodies: IBodies;
+}
+
+export class MissingBodyError extends Error {}
+
+function resolve<T>(hashes: string[], bodies: Map<string, unknown>): T[] {
+  return hashes.map((hash) => {
+    if (!bodies.has(hash)) {
+      throw new MissingBodyError(hash);
+    }
+    return bodies.get(hash) as T;
+  });
+}
+
+function resolveTools(
+  tools: string[] | null,
+  bodies: Map<string, unknown>
+): ILooplitState['tools'] {
+  // Tools are optional in the Python state
+  return (tools ? resolve(tools, bodies) : tools) as ILooplitState['tools'];
+}
+
+export function decodeState(
+  state: IEncodedState,
+  bodies: Map<string, unknown>
+): ILooplitState {
+  return {
+    ...state,
+    messages: resolve(state.messages, bodies),
+    tools: resolveTools(state.tools, bodies)
+  };
+}
+
+export function decodeStateDelta(
+  delta: IEncodedStateDelta,
+  bodies: Map<string, unknown>
+): IStateDelta {
+  const { tools, ...rest } = delta.fields;
+  const fields: Partial<ILooplitState> = rest;
+  if (tools !== undefined) {
+    fields.tools = resolveTools(tools, bodies);
+  }
+  return {
+    messages_start: delta.messages_start,
+    messages: resolve(delta.messages, bodies),
+    fields
+  };
+}
+
+export function applyStateDelta(
+  base: ILooplitState,
+  delta: IStateDelta
+): ILooplitState {
+  return {
+    ...base,
+    ...delta.fields,
+    messages: [
+      ...base.messages.slice(0, delta.messages_start),
+      ...delta.messages
+    ]
+  };
+}
+
+export interface IStreamDelta {
+  func_name: string;
+  lineage_id: string;
+  content: string;
+  tool_calls: {
+    index: number;
+    id: string | null;
+    name: string | null;
+    arguments: string;
+  }[];
+}
+
+export function applyStreamDelta(
+  message: IMessage | undefined,
+  { content, tool_calls }: IStreamDelta
+): IMessage {
+  const toolCalls = [...(message?.tool_calls || [])];
+  for (const delta of tool_calls) {
+    const prev = toolCalls[delta.index];
+    toolCalls[delta.index] = {
+      id: delta.id || prev?.id || '',
+      index: delta.index,
+      type: 'function',
+      function: {
+        name: delta.name || prev?.function.name || '',
+        arguments:
+          ((prev?.function.arguments as string) || '') + delta.arguments
+      }
+    };
+  }
+  return {
+    role: 'assistant',
+    content: ((message?.content as string) || '') + content,
+    tool_calls: toolCalls.length ? toolCalls : undefined
+  };
+}
@@ -32,6 +32,12 @@ export const toolCallsToLineageIdsState = atom<Record<string, string>>({
   default: {}
 });
 
+// Key of the lineages of a run loaded from the server, to fetch them on demand
+export const lineageKeysState = atom<Record<string, string>>({
+  key: 'lineageKeys',
+  default: {}
+});
+
 export const forksByMessageIndexState = atom<Record<string, string[][]>>({
   key: 'forksByMessageIndex',
   default: {}
@@ -66,11 +72,34 @@ export const interruptState = atom<IInterrupt | undefined>({
   default: undefined
 });
 
+// Assistant message being streamed, by lineage id
+export const streamingMessageByLineageState = atom<Record<string, IMessage>>({
+  key: 'StreamingMessageByLineage',
+  default: {}
+});
+
+// Generation of the stateful functions, incremented on each code reload
+export const codeGenerationState = atom<number | undefined>({
+  key: 'CodeGeneration',
+  default: undefined
+});
+
+// Generation that produced the last state of each lineage, by lineage id
+export const generationByLineageState = atom<Record<string, number>>({
+  key: 'GenerationByLineage',
+  default: {}
+});
+
 export const runningState = atom<boolean>({
   key: 'Running',
   default: false
 });
 
+export const replayFromCacheState = atom<boolean>({
+  key: 'ReplayFromCache',
+  default: false
+});
+
 export interface IError {
   lineage_id: string;
   error: string;
@@ -9,7 +9,11 @@ import Message, { IMessage } from '@/components/Message';
 import { Alert, AlertDescription, AlertTitle } from '@/components/ui/alert';
 import useCurrentState from '@/hooks/useCurrentState';
 import useSetEditState from '@/hooks/useSetEditState';
-import { errorState, runningState } from '@/state';
+import {
+  errorState,
+  runningState,
+  streamingMessageByLineageState
+} from '@/state';
 import { AlertCircle } from 'lucide-react';
 import { useCallback, useContext, useEffect, useRef } from 'react';
 import { useRecoilValue } from 'recoil';
@@ -28,6 +32,9 @@ export default function ChatBody() {
   const currentState = useCurrentState();
   const setEditState = useSetEditState();
   const error = useRecoilValue(errorState);
+  const streamingMessage = useRecoilValue(streamingMessageByLineageState)[
+    currentLineageId
+  ];
 
   // Handle scroll events to store position
   const handleScroll = useCallback((e: any) => {
@@ -40,7 +47,7 @@ export default function ChatBody() {
     if (ref.current && currentState?.messages && running) {
       ref.current.scrollTop = ref.current.scrollHeight;
     }
-  }, [currentState?.messages, running]);
+  }, [currentState?.messages, streamingMessage, running]);
 
   const onMessageChange = useCallback(
     (m: IMessage, index: number) => {
@@ -103,6 +110,23 @@ export default function ChatBody() {
           </Message>
         </div>
       ))}
+      {streamingMessage ? (
+        <div className="flex flex-col gap-1 border px-4 py-2 rounded-md bg-background">
+          <Message
+            maxHeight={Number.MAX_SAFE_INTEGER}
+            message={streamingMessage}
+          >
+            {streamingMessage.tool_calls?.map((tc) => (
+              <pre
+                key={tc.index}
+                className="text-xs text-muted-foreground whitespace-pre-wrap"
+              >
+                {tc.function.name}({tc.function.arguments as string})
+              </pre>
+            ))}
+          </Message>
+        </div>
+      ) : null}
       {error?.lineage_id === currentLineageId ? (
         <Alert variant="destructive">
           <AlertCircle className="h-4 w-4" />
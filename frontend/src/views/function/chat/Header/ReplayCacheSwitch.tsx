@@ -0,0 +1,19 @@
+import { Label } from '@/components/ui/label';
+import { Switch } from '@/components/ui/switch';
+import { replayFromCacheState } from '@/state';
+import { useRecoilState } from 'recoil';
+
+export default function ReplayCacheSwitch() {
+  const [replayFromCache, setReplayFromCache] =
+    useRecoilState(replayFromCacheState);
+  return (
+    <div className="flex items-center space-x-2 ml-2">
+      <Label htmlFor="replay-from-cache">Replay LLM calls</Label>
+      <Switch
+        checked={replayFromCache}
+        onCheckedChange={(c) => setReplayFromCache(c)}
+        id="replay-from-cache"
+      />
+    </div>
+  );
+}
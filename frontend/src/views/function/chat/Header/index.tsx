@@ -2,6 +2,7 @@ import FunctionViewContext from '../../context';
 import EditMode from './EditMode';
 import FunctionSelect from './FunctionSelect';
 import InterruptSwitch from './InterruptSwitch';
+import ReplayCacheSwitch from './ReplayCacheSwitch';
 import RunStateButton from './RunStateButton';
 import { Logo } from '@/components/Logo';
 import { SheetClose } from '@/components/ui/sheet';
@@ -33,6 +34,7 @@ export default function ChatHeader() {
       <div className="items-center flex">
         <EditMode />
         <InterruptSwitch />
+        <ReplayCacheSwitch />
       </div>
     </div>
   );
@@ -0,0 +1,40 @@
+import FunctionViewContext from '../../context';
+import { Badge } from '@/components/ui/badge';
+import {
+  Tooltip,
+  TooltipContent,
+  TooltipProvider,
+  TooltipTrigger
+} from '@/components/ui/tooltip';
+import { codeGenerationState, generationByLineageState } from '@/state';
+import { useContext } from 'react';
+import { useRecoilValue } from 'recoil';
+
+export default function GenerationBadge() {
+  const { currentLineageId } = useContext(FunctionViewContext);
+  const codeGeneration = useRecoilValue(codeGenerationState);
+  const generationByLineage = useRecoilValue(generationByLineageState);
+
+  const generation = generationByLineage[currentLineageId];
+  // Only known once the code has been reloaded
+  if (!codeGeneration || !generation || generation >= codeGeneration)
+    return null;
+
+  return (
+    <TooltipProvider delayDuration={100}>
+      <Tooltip>
+        <TooltipTrigger asChild>
+          <Badge variant="outline" className="ml-2 text-muted-foreground">
+            Outdated code
+          </Badge>
+        </TooltipTrigger>
+        <TooltipContent>
+          <p>
+            Produced by code generation {generation}, the code is now at
+            generation {codeGeneration}. Run it again to use the latest code.
+          </p>
+        </TooltipContent>
+      </Tooltip>
+    </TooltipProvider>
+  );
+}
@@ -0,0 +1,125 @@
+import FunctionViewContext from '../../context';
+import { Button } from '@/components/ui/button';
+import {
+  DropdownMenu,
+  DropdownMenuContent,
+  DropdownMenuItem,
+  DropdownMenuTrigger
+} from '@/components/ui/dropdown-menu';
+import {
+  Tooltip,
+  TooltipContent,
+  TooltipProvider,
+  TooltipTrigger
+} from '@/components/ui/tooltip';
+import {
+  IPersistedLineage,
+  getLineageStates,
+  getLineageToolCalls,
+  listLineages
+} from '@/lib/api';
+import {
+  editStateState,
+  errorState,
+  forksByMessageIndexState,
+  interruptState,
+  lineageKeysState,
+  runningState,
+  stateHistoryByLineageState,
+  toolCallsToLineageIdsState
+} from '@/state';
+import { HistoryIcon } from 'lucide-react';
+import { useContext, useState } from 'react';
+import { useRecoilValue, useSetRecoilState } from 'recoil';
+import { toast } from 'sonner';
+
+export default function HistoryButton() {
+  const { name, setCurrentLineageId, setCurrentStateIndex } =
+    useContext(FunctionViewContext);
+  const [lineages, setLineages] = useState<IPersistedLineage[]>();
+
+  const running = useRecoilValue(runningState);
+  const setStateHistoryByLineage = useSetRecoilState(
+    stateHistoryByLineageState
+  );
+  const setToolCallsToLineageIds = useSetRecoilState(
+    toolCallsToLineageIdsState
+  );
+  const setLineageKeys = useSetRecoilState(lineageKeysState);
+  const setForksByMessageIndex = useSetRecoilState(forksByMessageIndexState);
+  const setInterrupt = useSetRecoilState(interruptState);
+  const setEditState = useSetRecoilState(editStateState);
+  const setError = useSetRecoilState(errorState);
+
+  const handleOpenChange = (open: boolean) => {
+    if (!open) return;
+    // Only fetch the runs when asked for
+    listLineages(name)
+      .then(setLineages)
+      .catch((err) => toast.error('Failed to list the runs: ' + String(err)));
+  };
+
+  const loadLineage = async (lineage: IPersistedLineage) => {
+    try {
+      const [states, toolCalls] = await Promise.all([
+        getLineageStates(lineage.key),
+        getLineageToolCalls(lineage.key)
+      ]);
+
+      // The sub-agent lineages are fetched when opened
+      setStateHistoryByLineage({ [lineage.lineage_id]: states });
+      setToolCallsToLineageIds(
+        Object.fromEntries(toolCalls.map(({ tc, lid }) => [tc, lid]))
+      );
+      setLineageKeys(
+        Object.fromEntries(toolCalls.map(({ lid, key }) => [lid, key]))
+      );
+      setForksByMessageIndex({});
+
+      setInterrupt(undefined);
+      setError(undefined);
+      setEditState({});
+
+      setCurrentLineageId?.(() => lineage.lineage_id);
+      setCurrentStateIndex?.(() => Math.max(states.length - 1, 0));
+    } catch (err) {
+      toast.error('Failed to load the run: ' + String(err));
+    }
+  };
+
+  return (
+    <DropdownMenu onOpenChange={handleOpenChange}>
+      <TooltipProvider delayDuration={100}>
+        <Tooltip>
+          <TooltipTrigger asChild>
+            <DropdownMenuTrigger asChild>
+              <Button disabled={running} variant="ghost" size="icon">
+                <HistoryIcon />
+              </Button>
+            </DropdownMenuTrigger>
+          </TooltipTrigger>
+          <TooltipContent>
+            <p>Load a previous run</p>
+          </TooltipContent>
+        </Tooltip>
+      </TooltipProvider>
+      <DropdownMenuContent align="end">
+        {lineages?.length ? (
+          lineages.map((lineage) => (
+            <DropdownMenuItem
+              key={lineage.key}
+              onClick={() => loadLineage(lineage)}
+            >
+              {new Date(lineage.updated_at * 1000).toLocaleString()}
+              <span className="ml-auto pl-4 text-xs text-muted-foreground">
+                {lineage.states} states
+              </span>
+            </DropdownMenuItem>
+          ))
+        ) : (
+          <DropdownMenuItem disabled>No previous run</DropdownMenuItem>
+        )}
+      </DropdownMenuContent>
+    </DropdownMenu>
+  );
+}
@@ -1,4 +1,6 @@
 import FunctionViewContext from '../../context';
+import GenerationBadge from './GenerationBadge';
+import HistoryButton from './HistoryButton';
 import LineageNav from './LineageNav';
 import SaveButton from './SaveButton';
 import UploadButton from './UploadButton';
@@ -12,10 +14,12 @@ export default function StateHeader() {
       <div className="flex items-center">
         <span className="text-sm font-medium leading-none">State History</span>
         <LineageNav />
+        <GenerationBadge />
       </div>
       {isRoot ? (
         <div className="items-center flex gap-1">
           <EditorFormatSelect />
+          <HistoryButton />
           <SaveButton />
           <UploadButton />
         </div>
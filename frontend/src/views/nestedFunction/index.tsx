@@ -1,9 +1,11 @@
 import FunctionView from '../function';
 import FunctionViewContext, { IFunctionViewContext } from '../function/context';
 import { Sheet, SheetContent, SheetTrigger } from '@/components/ui/sheet';
-import { stateHistoryByLineageState } from '@/state';
+import { getLineageStates } from '@/lib/api';
+import { lineageKeysState, stateHistoryByLineageState } from '@/state';
 import { useMemo, useState } from 'react';
-import { useRecoilValue } from 'recoil';
+import { useRecoilValue, useSetRecoilState } from 'recoil';
+import { toast } from 'sonner';
 
 interface Props {
   children: React.ReactNode;
@@ -19,6 +21,8 @@ export default function NestedFunctionView({
   lineageId
 }: Props) {
   const stateHistory = useRecoilValue(stateHistoryByLineageState);
+  const setStateHistory = useSetRecoilState(stateHistoryByLineageState);
+  const lineageKeys = useRecoilValue(lineageKeysState);
 
   const [ctx, setCtx] = useState<IFunctionViewContext>({
     isRoot: false,
@@ -54,6 +58,21 @@ export default function NestedFunctionView({
     };
   }, [setCtx]);
 
+  const handleOpenChange = (open: boolean) => {
+    const key = lineageKeys[lineageId];
+    // The lineages of a run loaded from the server are fetched when opened
+    if (!open || !key || stateHistory[lineageId]) return;
+    getLineageStates(key)
+      .then((states) => {
+        setStateHistory((prev) => ({ ...prev, [lineageId]: states }));
+        setCtx((_ctx) => ({
+          ..._ctx,
+          currentStateIndex: Math.max(states.length - 1, 0)
+        }));
+      })
+      .catch((err) => toast.error('Failed to load the run: ' + String(err)));
+  };
+
   return (
     <FunctionViewContext.Provider
       value={{
@@ -61,7 +80,7 @@ export default function NestedFunctionView({
         ...setFns
       }}
     >
-      <Sheet>
+      <Sheet onOpenChange={handleOpenChange}>
         <SheetTrigger asChild>{children}</SheetTrigger>
         <SheetContent className="!max-w-[90%] w-full p-0 [&>button]:hidden">
           <FunctionView />